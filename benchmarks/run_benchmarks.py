@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of mdxcsv2inventory and the bulk paths of ldaptool.
+
+Synthetic mdx portal CSVs and ldap_users.csv/ldap_groups.csv are made
+in a temporary directory. The inventory generator is timed in-process,
+and ldap_addgroups/ldap_addusers run against the in-memory backend of
+ldaptool, counting subprocesses spawned and directory round trips.
+Results are written in JSON; --compare shows the ratio to a previous
+result.
+"""
+
+import argparse
+import contextlib
+import csv
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LDAPTOOL_BIN = os.path.join(TOP, "roles", "ldap_server", "files", "ldaptool", "bin")
+
+
+def load_script(path):
+    """
+    Import a script (which may have no .py suffix) as a module
+    """
+    name = os.path.basename(path).replace(".py", "").replace("-", "_")
+    loader = importlib.machinery.SourceFileLoader(name, path)
+    spec = importlib.util.spec_from_loader(name, loader)
+    mod = importlib.util.module_from_spec(spec)
+    loader.exec_module(mod)
+    return mod
+
+
+#
+# counting subprocesses and round trips
+#
+
+class Counter:
+    """
+    Count subprocesses spawned and calls of connection methods
+    while active
+    """
+    def __init__(self):
+        self.spawns = 0
+        self.round_trips = 0
+        self.patched = []
+
+    def patch(self, obj, attr, count):
+        orig = getattr(obj, attr)
+        def wrapper(*a, **kw):
+            count()
+            return orig(*a, **kw)
+        setattr(obj, attr, wrapper)
+        self.patched.append((obj, attr, orig))
+
+    def spawned(self):
+        self.spawns += 1
+
+    def round_trip(self):
+        self.round_trips += 1
+
+    def __enter__(self):
+        self.patch(subprocess.Popen, "__init__", self.spawned)
+        for cls_name in ("SubprocessConn", "LdapConn", "MemoryConn"):
+            cls = getattr(ldaptool(), cls_name)
+            for attr in ("search", "search_paged", "exists", "add",
+                         "modify", "delete", "apply_many"):
+                if hasattr(cls, attr):
+                    self.patch(cls, attr, self.round_trip)
+        return self
+
+    def __exit__(self, *exc):
+        for obj, attr, orig in reversed(self.patched):
+            setattr(obj, attr, orig)
+        self.patched = []
+
+
+_ldaptool = None
+
+def ldaptool():
+    global _ldaptool
+    if _ldaptool is None:
+        sys.path.insert(0, LDAPTOOL_BIN)
+        import ldaptool as mod
+        _ldaptool = mod
+    return _ldaptool
+
+
+#
+# synthetic data
+#
+
+def write_portal_csv(path, n_vms):
+    """
+    A CSV like the one of mdx user portal with n_vms VMs
+    """
+    with open(path, "w", encoding = "utf-8", newline = "") as f:
+        w = csv.writer(f)
+        w.writerow(["VM_NAME", "SERVICE_NET_1_IPv4", "SERVICE_NET_1_IPv6",
+                    "STORAGE_NET_1_IPv4", "STORAGE_NET_1_IPv6", "STATUS"])
+        for i in range(n_vms):
+            w.writerow(["vm{:06d}".format(i),
+                        "10.{}.{}.{}".format(11 + i // 65536, i // 256 % 256, i % 256),
+                        "2001:db8::{:x}".format(i + 1) if i % 4 else "",
+                        "10.{}.{}.{}".format(100 + i // 65536, i // 256 % 256, i % 256),
+                        "", "Running"])
+
+
+def inventory_group_args(n_vms, n_groups):
+    """
+    Options making n_groups groups of each kind
+    """
+    argv = []
+    for g in range(n_groups):
+        argv += ["-g", "re{}".format(g), "^vm0*{}[0-9]$".format(g)]
+        argv += ["-gv", "nre{}".format(g), "{}$".format(g % 10)]
+        argv += (["--group-with", "with{}".format(g)] +
+                 ["vm{:06d}".format((g * 37 + k) % n_vms) for k in range(20)])
+    return argv
+
+
+def write_ldap_csvs(d, n_users, n_groups):
+    """
+    ldap_groups.csv with n_groups groups and ldap_users.csv with
+    n_users users, each in a few of the groups
+    """
+    groups_csv = os.path.join(d, "ldap_groups.csv")
+    users_csv = os.path.join(d, "ldap_users.csv")
+    with open(groups_csv, "w", encoding = "utf-8", newline = "") as f:
+        w = csv.writer(f)
+        w.writerow(["grp", "cn", "gid"])
+        for g in range(n_groups):
+            w.writerow(["g{}".format(g), "g{}".format(g), ""])
+    with open(users_csv, "w", encoding = "utf-8", newline = "") as f:
+        w = csv.writer(f)
+        w.writerow(["user", "grp", "cn", "sn", "shell", "uid", "gid", "home",
+                    "home_perm", "authorized_keys", "groups",
+                    "password_hash", "password"])
+        for u in range(n_users):
+            groups = " ".join("g{}".format((u + k) % n_groups) for k in range(3))
+            plain = "pw{}".format(u) if u % 10 == 0 else ""
+            w.writerow(["u{}".format(u), "", "", "", "", "", "", "-", "", "",
+                        groups, "" if plain else "{SSHA}x", plain])
+    return groups_csv, users_csv
+
+
+#
+# benchmarks
+#
+
+def bench_inventory(inventory, csv_path, argv):
+    """
+    Time generate_inventory with argv, writing to memory
+    """
+    args = inventory.parse_args(argv + ["--no-cache", csv_path])
+    with contextlib.ExitStack() as stack:
+        for f in args.csv:
+            stack.enter_context(f)
+        out = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            inventory.generate_inventory(args)
+        return time.perf_counter() - start
+
+
+def bench_ldap(groups_csv, users_csv, batch):
+    """
+    Time ldap_addgroups and then ldap_addusers against one in-memory
+    directory, counting subprocesses and round trips of each
+    """
+    lt = ldaptool()
+    addgroups = load_script(os.path.join(LDAPTOOL_BIN, "ldap_addgroups"))
+    addusers = load_script(os.path.join(LDAPTOOL_BIN, "ldap_addusers"))
+    common = ["--ldap-domain", "dc=bench", "--ldap-passwd", "x",
+              "--backend", "memory"] + (["--batch"] if batch else [])
+
+    # both tools talk to the same in-memory directory
+    conns = {}
+    connect = lt.connect
+    lt.connect = lambda info: conns.setdefault("conn", connect(info))
+    results = []
+    try:
+        for name, mod, run, argv in (
+                ("ldap_addgroups", addgroups, addgroups.addgroups_of_opt, [groups_csv]),
+                ("ldap_addusers", addusers, addusers.addusers_of_opt,
+                 [users_csv, "--hash-workers", "1"])):
+            opts = mod.parse_args([name] + argv + common)
+            lt.PROFILE = lt.Profile()
+            with Counter() as counter, contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                err = run(opts)
+                elapsed = time.perf_counter() - start
+            results.append({"name": name + (" --batch" if batch else ""),
+                            "seconds": elapsed, "errors": err,
+                            "spawns": counter.spawns,
+                            "round_trips": counter.round_trips,
+                            "ops": lt.PROFILE.summary()["ops"]})
+    finally:
+        lt.connect = connect
+    return results
+
+
+def run_benchmarks(opts):
+    inventory = load_script(os.path.join(TOP, "mdxcsv2inventory.py"))
+    results = []
+    with tempfile.TemporaryDirectory() as d:
+        for n_vms in opts.vms:
+            csv_path = os.path.join(d, "vms{}.csv".format(n_vms))
+            write_portal_csv(csv_path, n_vms)
+            groups = inventory_group_args(n_vms, opts.inventory_groups)
+            for name, argv in (("inventory ini", []),
+                               ("inventory ini groups", groups),
+                               ("inventory json groups", groups + ["--list"])):
+                times = [bench_inventory(inventory, csv_path, argv)
+                         for _ in range(opts.repeat)]
+                results.append({"name": name, "size": n_vms,
+                                "seconds": min(times)})
+                print("{} ({} VMs): {:.3f}s".format(name, n_vms, min(times)),
+                      file = sys.stderr)
+
+        for n_users in opts.users:
+            groups_csv, users_csv = write_ldap_csvs(d, n_users, opts.ldap_groups)
+            for batch in (False, True):
+                for r in bench_ldap(groups_csv, users_csv, batch):
+                    r["size"] = n_users if "users" in r["name"] else opts.ldap_groups
+                    results.append(r)
+                    print("{} ({}): {:.3f}s, {} spawns, {} round trips".format(
+                        r["name"], r["size"], r["seconds"],
+                        r["spawns"], r["round_trips"]), file = sys.stderr)
+
+    return {"python": platform.python_version(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results}
+
+
+def compare(old, new):
+    """
+    Print the ratio of each result in new to the same one in old
+    """
+    key = lambda r: (r["name"], r["size"])
+    before = {key(r): r for r in old["results"]}
+    for r in new["results"]:
+        o = before.get(key(r))
+        if not o or not o["seconds"]:
+            continue
+        print("{} ({}): {:.3f}s -> {:.3f}s ({:.2f}x)".format(
+            r["name"], r["size"], o["seconds"], r["seconds"],
+            r["seconds"] / o["seconds"]), file = sys.stderr)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = __doc__.strip().split("\n")[0])
+    parser.add_argument("--vms", type = int, nargs = "+",
+                        default = [1000, 10000, 100000],
+                        help = "numbers of VMs in portal CSVs")
+    parser.add_argument("--inventory-groups", type = int, default = 100,
+                        help = "number of groups of each kind (-g, -gv, --group-with)")
+    parser.add_argument("--users", type = int, nargs = "+", default = [1000, 10000],
+                        help = "numbers of users in ldap_users.csv")
+    parser.add_argument("--ldap-groups", type = int, default = 100,
+                        help = "number of groups in ldap_groups.csv")
+    parser.add_argument("--repeat", type = int, default = 3,
+                        help = "runs of each inventory benchmark (the best is taken)")
+    parser.add_argument("--output", help = "JSON file to write results to, default is STDOUT")
+    parser.add_argument("--compare", help = "JSON file of previous results to compare with")
+    opts = parser.parse_args()
+
+    result = run_benchmarks(opts)
+    text = json.dumps(result, indent = 1) + "\n"
+    if opts.output:
+        with open(opts.output, "w", encoding = "utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+    if opts.compare:
+        with open(opts.compare, encoding = "utf-8") as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,42 +2,195 @@
 
 import argparse
 import csv
+import hashlib
+import heapq
+import io
+import itertools
+import os
+import socket
 import sys
 import json
 import re
-from ipaddress import ip_network, ip_address
+from ipaddress import (IPv4Address, IPv4Network, IPv6Address, IPv6Network,
+                       collapse_addresses)
 
 def csv2dictlist(csvfile):
     reader = csv.DictReader(csvfile)
     return [ row for row in reader ]
 
+def warn(message):
+    print("mdxcsv2inventory: " + message, file = sys.stderr)
+
+def project_names(files):
+    """
+    Return the project name of each CSV file: the file name without
+    the suffix and with non-word characters replaced by _, and _2, _3,
+    ... appended if files have the same name
+    """
+    names = []
+    for f in files:
+        stem = os.path.splitext(os.path.basename(f.name.strip("<>")))[0]
+        name = base = re.sub(r"\W", "_", stem) or "project"
+        n = 1
+        while name in names:
+            n += 1
+            name = "{}_{}".format(base, n)
+        names.append(name)
+    return names
+
+def sorted_rows(f):
+    """
+    Return rows of the CSV file f in the order of VM_NAME. A file
+    already in that order is checked a row at a time and then read
+    again as a stream; another file (or a pipe) is sorted in memory.
+    """
+    if f.seekable():
+        names, following = itertools.tee(row["VM_NAME"]
+                                         for row in csv.DictReader(f))
+        next(following, None)
+        ordered = all(a <= b for a, b in zip(names, following))
+        f.seek(0)
+        if ordered:
+            return csv.DictReader(f)
+    rows = csv2dictlist(f)
+    rows.sort(key = lambda x: x["VM_NAME"])
+    return rows
+
+def read_vms(args):
+    """
+    Read VMs of the CSV files args.csv sorted by VM_NAME, and return
+    (vms, [index of the CSV of each VM, ...]). The files are merged a
+    row at a time (see sorted_rows); only files not sorted already
+    are held whole besides the VMs themselves, which groups are made
+    over. VMs of the same name stay in the order of the files, and a
+    VM whose name is already in an earlier CSV is reported and
+    ignored.
+    """
+    runs = [zip(itertools.repeat(i), sorted_rows(f))
+            for i, f in enumerate(args.csv)]
+
+    vms, projects = [], []
+    last, owner = None, None
+    for i, vm in heapq.merge(*runs, key = lambda x: x[1]["VM_NAME"]):
+        name = vm["VM_NAME"]
+        if name != last:
+            last, owner = name, i
+        elif i != owner:
+            warn("duplicate VM name {} in {} ignored (already in {})".format(
+                name, args.csv[i].name, args.csv[owner].name))
+            continue
+        vms.append(vm)
+        projects.append(i)
+    return vms, projects
+
+def overlapping_addresses(vms, table, projects):
+    """
+    Return [(address, VM, VM of another CSV), ...] for each address
+    of VMs in table (made by validate_vms) that a VM in another CSV
+    also has
+    """
+    owners = {}
+    overlaps = []
+    for net in sorted(table):
+        version = net[2]
+        for pos, addr in enumerate(table[net]):
+            if addr is None:
+                continue
+            first = owners.setdefault((version, addr), pos)
+            if projects[first] != projects[pos]:
+                address = (IPv4Address if version == 4 else IPv6Address)(addr)
+                overlaps.append((address, vms[first], vms[pos]))
+    return overlaps
+
+# columns of addresses of VMs on the networks
+NET_COLUMN = re.compile(r"^(SERVICE|STORAGE)_NET_(\d+)_IPv([46])$")
+
+def parse_address(value):
+    """
+    Return (version, address as an integer) of an IP address string,
+    or None if it is not an IP address
+    """
+    for version, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            # a scope (fe80::1%eth0) is allowed as ip_address() does
+            addr = value.split("%", 1)[0] if version == 6 else value
+            packed = socket.inet_pton(family, addr)
+            return version, int.from_bytes(packed, "big")
+        except OSError:
+            continue
+    return None
+
+def is_link_local_ipv6(addr):
+    return (addr >> 118) == (0xfe80 >> 6)
+
 def validate_vms(vms, enable_linklocal):
     """
-    Validate values for *_IPv* are IP addresses
+    Validate values for *_IPv* are IP addresses, and return the
+    addresses on the networks as a table
+    {(SERVICE|STORAGE, N, 4|6): [address as an integer or None, ...]}
+    in the order of vms. Each value is parsed only once.
     """
-    for vm in vms:
-        for key in vm.keys():
-            if vm[key] and "_IPv" in key:
-                try:
-                    addr = ip_address(vm[key])
-                    if (not enable_linklocal and
-                        addr.version == 6 and addr.is_link_local):
-                        vm[key] = ""
-                except ValueError:
+    columns = set(key for vm in vms for key in vm.keys()
+                  if key and "_IPv" in key)
+    table = {}
+    for key in sorted(columns):
+        m = NET_COLUMN.match(key)
+        net = (m.group(1), int(m.group(2)), int(m.group(3))) if m else None
+        addrs = [None] * len(vms)
+        for pos, vm in enumerate(vms):
+            value = vm.get(key)
+            if not value:
+                continue
+            parsed = parse_address(value)
+            if parsed is None:
+                vm[key] = ""
+                continue
+            version, addr = parsed
+            if version == 6 and is_link_local_ipv6(addr):
+                # never in the prefixes of the networks
+                if not enable_linklocal:
                     vm[key] = ""
+                continue
+            if net and version == net[2]:
+                addrs[pos] = addr
+        if net:
+            table[net] = addrs
+    return table
 
 
-def printvm(vm, args):
-
+def vm_address(vm, args):
+    """
+    Return the service address of vm used as the host in the inventory
+    """
     keys = ["SERVICE_NET_1_IPv4", "SERVICE_NET_1_IPv6"]
     if args.use_ipv6:
         keys.reverse()
 
-    addr = None
     for key in keys:
         if vm[key]:
-            addr = vm[key]
-            break
+            return vm[key]
+    return None
+
+def vm_hostvars(vm, args):
+    """
+    Return host vars of vm, the same as printvm writes
+    """
+    hostvars = {"hostname": vm["VM_NAME"]}
+
+    if vm["SERVICE_NET_1_IPv4"]:
+        hostvars["ethipv4"] = vm["SERVICE_NET_1_IPv4"]
+
+    if vm["STORAGE_NET_1_IPv4"]:
+        hostvars["rdmaipv4"] = vm["STORAGE_NET_1_IPv4"]
+
+    if vm["SERVICE_NET_1_IPv6"] and args.enable_ethipv6:
+        hostvars["ethipv6"] = vm["SERVICE_NET_1_IPv6"]
+
+    return hostvars
+
+def printvm(vm, args):
+
+    addr = vm_address(vm, args)
 
     if not addr:
         out = "# !! no service address available for {}".format(vm["VM_NAME"])
@@ -55,151 +208,738 @@ def printvm(vm, args):
 
     args.output.write(out + "\n")
 
-def get_ipv4prefix(vms):
-    # XXX: Assuming SERVICE|STORAGE_NET_1
-    ethipv4prefix = None
-    rdmaipv4prefix = None
-    for vm in vms:
-        if vm["SERVICE_NET_1_IPv4"]:
-            ethipv4prefix = ip_network(vm["SERVICE_NET_1_IPv4"] + "/21",
-                                         strict = False)
-        if vm["STORAGE_NET_1_IPv4"]:
-            rdmaipv4prefix = ip_network(vm["STORAGE_NET_1_IPv4"] + "/21",
-                                        strict = False)
-        if ethipv4prefix and rdmaipv4prefix:
-            break
-    return ethipv4prefix, rdmaipv4prefix
+def covering_prefixes(addrs, version, prefixlen):
+    """
+    Return the networks of prefixlen bits that addrs (integers) are
+    on, collapsed into as few networks as possible. VMs added later on
+    the same subnets are also in them, and addresses on distant
+    subnets never widen them to a common supernet.
+    """
+    bits = 32 if version == 4 else 128
+    network = IPv4Network if version == 4 else IPv6Network
+    shift = bits - prefixlen
+    subnets = set(addr >> shift for addr in addrs)
+    return list(collapse_addresses(network((subnet << shift, prefixlen))
+                                   for subnet in sorted(subnets)))
 
+def get_prefixes(table, kind, version, prefixlen):
+    """
+    Return the networks of prefixlen bits covering addresses on the
+    networks kind (SERVICE or STORAGE) with IP version
+    """
+    addrs = [addr for net in table if net[0] == kind and net[2] == version
+             for addr in table[net] if addr is not None]
+    return covering_prefixes(addrs, version, prefixlen) if addrs else []
 
-def get_ipv6prefix(vms):
-    # XXX: Assuming SERVICE_NET_1
-    ethipv6prefix = None
-    for vm in vms:
-        if vm["SERVICE_NET_1_IPv6"]:
-            ethipv6prefix = ip_network(vm["SERVICE_NET_1_IPv6"] + "/64",
-                                strict = False)
-            if ethipv6prefix.is_link_local:
-                continue
 
-            return ethipv6prefix
+def index_vms(vms):
+    """
+    Make a table from VM name to the positions of VMs in vms
+    """
+    index = {}
+    for pos, vm in enumerate(vms):
+        index.setdefault(vm["VM_NAME"], []).append(pos)
+    return index
+
 
-    return None
+def positions_of(names, index):
+    """
+    Positions of VMs named in names, in the order of vms
+    """
+    return sorted(set(pos for name in set(names)
+                      for pos in index.get(name, ())))
 
 
-def generate_group_with(vms, args):
+def combine_regexps(regexps):
+    """
+    Make a tree of combined matchers for regexps [(n, regexp), ...].
+    A node is (matcher, [n]) for a leaf or (matcher, [child, child]),
+    where matcher is the alternation of all regexps under the node.
+    """
+    matcher = re.compile("|".join("(?:{})".format(regexp)
+                                  for _, regexp in regexps))
+    if len(regexps) == 1:
+        return matcher, [regexps[0][0]]
+    half = len(regexps) // 2
+    return matcher, [combine_regexps(regexps[:half]),
+                     combine_regexps(regexps[half:])]
+
+def search_combined(node, name, found):
+    """
+    Add n of all regexps in the tree node found in name to found.
+    A subtree is visited only if its combined matcher matches.
+    """
+    matcher, children = node
+    if not matcher.search(name):
+        return
+    for child in children:
+        if isinstance(child, tuple):
+            search_combined(child, name, found)
+        else:
+            found.append(child)
+
+def match_regexps(vms, regexps):
+    """
+    Return a set of positions of VMs whose names match for each
+    regexp. All regexps are evaluated in a single pass over vms with
+    a tree of combined matchers; a regexp that cannot be combined
+    (it has global flags or backreferences) is matched by itself.
+    """
+    matched = [set() for _ in regexps]
+    combined = []
+    alone = []
+    for n, regexp in enumerate(regexps):
+        if re.search(r"\\\d|\(\?P=|\(\?[aiLmsux]+\)", regexp):
+            alone.append(n)
+        else:
+            combined.append((n, regexp))
+
+    tree = None
+    if combined:
+        try:
+            tree = combine_regexps(combined)
+        except re.error:
+            # e.g., the same group name used in two regexps
+            alone += [n for n, _ in combined]
+
+    single = [(n, re.compile(regexps[n])) for n in alone]
+    for pos, vm in enumerate(vms):
+        name = vm["VM_NAME"]
+        found = []
+        if tree:
+            search_combined(tree, name, found)
+        found += [n for n, regexp in single if regexp.search(name)]
+        for n in found:
+            matched[n].add(pos)
+    return matched
 
-    w = lambda x: args.output.write(x + "\n")
 
+def generate_group_with(vms, index, args):
+    """
+    Return groups [(group, comment, vms), ...] of --group-with
+    """
+    groups = []
     for attrs in args.group_with:
-        groupname = attrs.pop(0)
-        if not attrs:
+        groupname, names = attrs[0], attrs[1:]
+        if not names:
             msg = "no VM name specifeid for --group-with {}".format(groupname)
             raise AttributeError(msg)
 
-        w("[{}]".format(groupname))
-        w("# group with {}".format(" ".join(attrs)))
-        for vm in filter(lambda v: v["VM_NAME"] in attrs, vms):
-            printvm(vm, args)
-        w("")
-
-def generate_group_without(vms, args):
-
-    w = lambda x: args.output.write(x + "\n")
+        comment = "# group with {}".format(" ".join(names))
+        members = [vms[pos] for pos in positions_of(names, index)]
+        groups.append((groupname, comment, members))
+    return groups
 
+def generate_group_without(vms, index, args):
+    """
+    Return groups [(group, comment, vms), ...] of --group-without
+    """
+    groups = []
     for attrs in args.group_without:
-        groupname = attrs.pop(0)
+        groupname, names = attrs[0], attrs[1:]
 
-        w("[{}]".format(groupname))
-        w("# group without {}".format(" ".join(attrs)))
-        for vm in filter(lambda v: not v["VM_NAME"] in attrs, vms):
-            printvm(vm, args)
-        w("")
+        comment = "# group without {}".format(" ".join(names))
+        excluded = set(positions_of(names, index))
+        members = [vm for pos, vm in enumerate(vms) if pos not in excluded]
+        groups.append((groupname, comment, members))
+    return groups
 
 def generate_group_regexp(vms, args, group_args, invert = False):
+    """
+    Return groups [(group, comment, vms), ...] of -g or -gv
+    """
+    matched = match_regexps(vms, [attrs[1] for attrs in group_args])
+    m = "with" if not invert else "without"
 
-    w = lambda x: args.output.write(x + "\n")
-
-    for attrs in group_args:
+    groups = []
+    for attrs, positions in zip(group_args, matched):
         groupname = attrs[0]
-        regexp = re.compile(attrs[1])
-
+        comment = "# group {} regexp '{}'".format(m, attrs[1])
         if not invert:
-            f = lambda v: regexp.search(v["VM_NAME"])
-            m = "with"
+            members = [vms[pos] for pos in sorted(positions)]
         else:
-            f = lambda v: not regexp.search(v["VM_NAME"])
-            m = "without"
+            members = [vm for pos, vm in enumerate(vms)
+                       if pos not in positions]
+        groups.append((groupname, comment, members))
+    return groups
+
+def generate_batch_groups(vms, args):
+    """
+    Return groups batch_0, batch_1, ... splitting VMs having a service
+    address into args.batch_size VMs each, for rolling updates
+    """
+    hosts = [vm for vm in vms if vm_address(vm, args)]
+    size = args.batch_size
 
-        w("[{}]".format(groupname))
-        w("# group {} regexp '{}'".format(m, attrs[1]))
-        for vm in filter(f, vms):
-            printvm(vm, args)
-        w("")
+    groups = []
+    for n, start in enumerate(range(0, len(hosts), size)):
+        groupname = "{}{}".format(args.batch_prefix, n)
+        members = hosts[start:start + size]
+        comment = "# batch {} of {} VMs".format(n, len(members))
+        groups.append((groupname, comment, members))
+    return groups
 
-def generate_inventory(args):
+def generate_subnet_groups(vms, table, args):
+    """
+    Return groups of VMs on each subnet of args.subnet_groups bits
+    on the storage (RDMA) networks, e.g., rdma_10_12_0_0_24
+    """
+    prefixlen = args.subnet_groups
+    shift = 32 - prefixlen
 
-    vms = csv2dictlist(args.csv)
-    validate_vms(vms, args.enable_linklocal)
-    vms.sort(key = lambda x: x["VM_NAME"])
-    ethipv4prefix, rdmaipv4prefix = get_ipv4prefix(vms)
-    ethipv6prefix = get_ipv6prefix(vms)
+    subnets = {}
+    for net in sorted(k for k in table if k[0] == "STORAGE" and k[2] == 4):
+        for pos, addr in enumerate(table[net]):
+            if addr is not None:
+                subnets.setdefault(addr >> shift, set()).add(pos)
 
-    w = lambda x: args.output.write(x + "\n")
+    groups = []
+    for subnet in sorted(subnets):
+        network = IPv4Network((subnet << shift, prefixlen))
+        groupname = "rdma_{}_{}".format(
+            str(network.network_address).replace(".", "_"), prefixlen)
+        comment = "# group on RDMA subnet {}".format(network)
+        members = [vms[pos] for pos in sorted(subnets[subnet])]
+        groups.append((groupname, comment, members))
+    return groups
 
-    # write vars for all node group
-    w("[all:vars]")
-    w("ansible_user={}".format(args.ansible_user))
-    w("ansible_remote_tmp=/tmp/.ansible")
-    if ethipv4prefix:
-        w("ethipv4prefix={}".format(ethipv4prefix))
-    else:
-        w("# no valid IPv4 prefix for Ethernet network found")
-    if rdmaipv4prefix:
-        w("rdmaipv4prefix={}".format(rdmaipv4prefix))
-    else:
-        w("# no valid IPv4 prefix for RDMA network found")
-    if ethipv6prefix:
-        w("ethipv6prefix={}".format(ethipv6prefix))
-    else:
-        w("# no valid IPv6 prefix for Ethernet network found")
-    w("")
+def generate_project_groups(vms, projects, args):
+    """
+    Return a group of VMs of each CSV, named after the project of
+    the CSV, e.g., project_myproject for myproject.csv
+    """
+    members = {}
+    for vm, i in zip(vms, projects):
+        members.setdefault(i, []).append(vm)
+
+    groups = []
+    for i, name in enumerate(args.projects):
+        groupname = "{}{}".format(args.project_prefix, name)
+        comment = "# VMs in {}".format(args.csv[i].name)
+        groups.append((groupname, comment, members.get(i, [])))
+    return groups
 
-    # write a group that contains all nodes
-    w("[{}]".format(args.default_group))
+def write_group(groupname, comment, vms, args):
+
+    w = lambda x: args.output.write(x + "\n")
+
+    w("[{}]".format(groupname))
+    if comment:
+        w(comment)
     for vm in vms:
         printvm(vm, args)
     w("")
-    
-    # write user-specified groups
+
+# comments written instead of vars not found
+NO_VALUE_COMMENTS = {
+    "ethipv4prefix": "# no valid IPv4 prefix for Ethernet network found",
+    "rdmaipv4prefix": "# no valid IPv4 prefix for RDMA network found",
+    "ethipv6prefix": "# no valid IPv6 prefix for Ethernet network found",
+}
+
+def get_all_vars(table, args):
+    """
+    Return vars for all nodes [(var, value), ...]; value is None for
+    a var not found
+    """
+    ethipv4prefix = get_prefixes(table, "SERVICE", 4, args.ipv4_prefixlen)
+    rdmaipv4prefix = get_prefixes(table, "STORAGE", 4, args.ipv4_prefixlen)
+    ethipv6prefix = get_prefixes(table, "SERVICE", 6, args.ipv6_prefixlen)
+
+    prefixes = lambda p: [str(net) for net in p] if p else None
+
+    return [("ansible_user", args.ansible_user),
+            ("ansible_remote_tmp", "/tmp/.ansible"),
+            ("ethipv4prefix", prefixes(ethipv4prefix)),
+            ("rdmaipv4prefix", prefixes(rdmaipv4prefix)),
+            ("ethipv6prefix", prefixes(ethipv6prefix))]
+
+def build_inventory(vms, table, args, projects = None):
+    """
+    Return vars for all nodes and groups [(group, comment, vms), ...]
+    in the order they are written. table is the addresses of vms
+    made by validate_vms, and projects the CSV of each VM made by
+    read_vms.
+    """
+    all_vars = get_all_vars(table, args)
+
+    # a group that contains all nodes
+    groups = [(args.default_group, None, vms)]
+
+    index = index_vms(vms)
+
+    # user-specified groups
     if args.group_with:
-        generate_group_with(vms, args)
+        groups += generate_group_with(vms, index, args)
 
     if args.group_without:
-        generate_group_without(vms, args)
+        groups += generate_group_without(vms, index, args)
 
-    # write groups with regexp
+    # groups with regexp
     if args.group_regexp:
-        generate_group_regexp(vms, args, args.group_regexp, invert = False)
+        groups += generate_group_regexp(vms, args, args.group_regexp,
+                                        invert = False)
 
-    # write groups with regexp
+    # groups without regexp
     if args.group_regexp_invert:
-        generate_group_regexp(vms, args, args.group_regexp_invert,
-                              invert = True)
+        groups += generate_group_regexp(vms, args, args.group_regexp_invert,
+                                        invert = True)
+
+    # groups for rolling updates and groups per RDMA subnet
+    if args.batch_size:
+        groups += generate_batch_groups(vms, args)
+
+    if args.subnet_groups:
+        groups += generate_subnet_groups(vms, table, args)
+
+    if args.project_groups and projects is not None:
+        groups += generate_project_groups(vms, projects, args)
 
-    # write per-node groups
+    # per-node groups
     if args.per_node_groups:
-        for vm in filter(lambda v: v["SERVICE_NET_1_IPv4"], vms):
-            w("[{}]".format(vm["VM_NAME"]))
-            printvm(vm, args)
-            w("")
-            
+        groups += [(vm["VM_NAME"], None, [vm])
+                   for vm in vms if vm["SERVICE_NET_1_IPv4"]]
 
-def main():
+    return all_vars, groups
+
+def write_ini(all_vars, groups, args):
+
+    w = lambda x: args.output.write(x + "\n")
+
+    # write vars for all node group
+    w("[all:vars]")
+    for var, value in all_vars:
+        if value is None:
+            w(NO_VALUE_COMMENTS[var])
+        elif isinstance(value, list):
+            w("{}={}".format(var, json.dumps(value)))
+        else:
+            w("{}={}".format(var, value))
+    w("")
+
+    for groupname, comment, members in groups:
+        write_group(groupname, comment, members, args)
+
+def inventory_json(all_vars, groups, args):
+    """
+    Return the inventory in the JSON format of inventory scripts
+    (ansible-inventory --list), with host vars in _meta.hostvars
+    """
+    inventory = {"all": {"vars": {var: value
+                                  for var, value in all_vars
+                                  if value is not None}}}
+    hostvars = {}
+    seen = {}
+    for groupname, _, members in groups:
+        hosts = inventory.setdefault(groupname, {}).setdefault("hosts", [])
+        in_group = seen.setdefault(groupname, set())
+        for vm in members:
+            addr = vm_address(vm, args)
+            if not addr or addr in in_group:
+                continue
+            in_group.add(addr)
+            hosts.append(addr)
+            hostvars.setdefault(addr, vm_hostvars(vm, args))
+    inventory["_meta"] = {"hostvars": hostvars}
+    return inventory
+
+def csv_digest(args):
+    """
+    Return a sha256 of the content of the CSV files args.csv, reading
+    them a block at a time and rewinding them. A file that cannot be
+    rewound (a pipe) is read into memory and replaced in args.csv.
+    """
+    h = hashlib.sha256()
+    for i, f in enumerate(args.csv):
+        if not f.seekable():
+            name = f.name
+            f = args.csv[i] = io.StringIO(f.read())
+            f.name = name
+        for block in iter(lambda: f.read(1 << 16), ""):
+            h.update(block.encode("utf-8"))
+        h.update(b"\0")
+        f.seek(0)
+    return h
+
+def cache_path(h, args):
+    """
+    Return the cache file for the CSV content digest h and args
+    """
+    ignored = ("csv", "output", "list", "host", "cache_dir", "no_cache",
+               "state", "print_limit")
+    opts = {k: v for k, v in vars(args).items() if k not in ignored}
+    h.update(json.dumps(opts, sort_keys = True).encode("utf-8"))
+    return os.path.join(args.cache_dir, h.hexdigest() + ".json")
+
+def read_cache(path):
+    try:
+        with open(path, encoding = "utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def write_cache(path, content, keep = 10):
+    """
+    Write content to the cache file path atomically, and remove old
+    cache files except the latest keep ones
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, "w", encoding = "utf-8") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+        cache_dir = os.path.dirname(path)
+        files = [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)
+                 if f.endswith(".json")]
+        files.sort(key = os.path.getmtime, reverse = True)
+        for f in files[keep:]:
+            os.remove(f)
+    except OSError:
+        # the cache is only for speed
+        pass
+
+# files made in --artifacts-dir, referenced by vars for all nodes
+ETC_HOSTS_FRAGMENT = "etc_hosts.cluster"
+NGINX_PROXY_FRAGMENT = "nginx.jupyterlab.proxy.j2"
+PROXY_PORTS = "proxy_ports.json"
+
+NGINX_PROXY_HEADER = """# Nginx configuration for reverse proxy for jupyter lab
+
+map $http_upgrade $connection_upgrade {
+    default upgrade;
+    ''      close;
+}
+
+proxy_buffering off;
+proxy_redirect   off;
+proxy_set_header X-Real-IP $remote_addr;
+proxy_set_header Host $host:$server_port;
+proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+proxy_set_header X-Forwarded-Proto $scheme;
+
+proxy_http_version 1.1;
+proxy_set_header Upgrade $http_upgrade;
+proxy_set_header Connection $connection_upgrade;
+proxy_set_header X-Scheme $scheme;
+
+"""
+
+NGINX_PROXY_SERVER = """server {{
+\t# Proxy Rule for {hostname}
+\tserver_name\t_;
+\tlisten {port};
+\tlocation / {{
+\t\tproxy_pass http://{ethipv4}:{{{{ proxy_port }}}};
+\t}}
+}}
+
+"""
+
+def assign_proxy_ports(names, old, first = 8001):
+    """
+    Return {VM name: port} for names. VMs in old keep their ports,
+    and the others get the lowest ports not used.
+    """
+    ports = {name: old[name] for name in names if name in old}
+    used = set(ports.values())
+    port = first
+    for name in names:
+        if name in ports:
+            continue
+        while port in used:
+            port += 1
+        ports[name] = port
+        used.add(port)
+    return ports
+
+def group_hosts(groups, groupname, args):
+    """
+    VMs having a service address in groupname of groups made by
+    build_inventory, once each in the order of the groups
+    """
+    hosts = {}
+    found = False
+    for name, _, members in groups:
+        if name == groupname:
+            found = True
+            for vm in members:
+                if vm_address(vm, args):
+                    hosts.setdefault(id(vm), vm)
+    if not found:
+        warn("group {} for --artifacts-dir not in the inventory".format(
+            groupname))
+    return list(hosts.values())
+
+def write_artifacts(groups, args):
+    """
+    Write the hosts of args.etc_hosts_group for /etc/hosts and the
+    reverse proxy configuration of args.jupyter_host_group to
+    args.artifacts_dir, so that roles copy them instead of looping
+    over hostvars on every host. groups are made by build_inventory.
+    Return vars for all nodes [(var, path), ...] referencing them.
+    """
+    d = os.path.abspath(args.artifacts_dir)
+    os.makedirs(d, exist_ok = True)
+    hosts = group_hosts(groups, args.etc_hosts_group, args)
+
+    # the same as roles/common/templates/etc_hosts.j2 writes
+    eth = ["{}\t{}\n".format(vm["SERVICE_NET_1_IPv4"], vm["VM_NAME"])
+           for vm in hosts if vm["SERVICE_NET_1_IPv4"]]
+    rdma = ["{}\t{}-rdma\n".format(vm["STORAGE_NET_1_IPv4"], vm["VM_NAME"])
+            for vm in hosts if vm["STORAGE_NET_1_IPv4"]]
+    etc_hosts = ("# Addresses on the Ethernet network\n" + "".join(eth) +
+                 "\n# Addresses on the RDMA network\n" + "".join(rdma))
+    write_if_changed(os.path.join(d, ETC_HOSTS_FRAGMENT), etc_hosts)
+
+    # the same as roles/reverse_proxy/templates/nginx.jupyterlab.proxy.j2
+    # writes, but a port once given to a VM is kept
+    proxied = [vm for vm in group_hosts(groups, args.jupyter_host_group, args)
+               if vm["SERVICE_NET_1_IPv4"]]
+    ports_path = os.path.join(d, PROXY_PORTS)
+    try:
+        with open(ports_path, encoding = "utf-8") as f:
+            old = json.load(f)
+    except FileNotFoundError:
+        old = {}
+    ports = assign_proxy_ports([vm["VM_NAME"] for vm in proxied], old)
+    servers = [NGINX_PROXY_SERVER.format(hostname = vm["VM_NAME"],
+                                         port = ports[vm["VM_NAME"]],
+                                         ethipv4 = vm["SERVICE_NET_1_IPv4"])
+               for vm in sorted(proxied, key = lambda v: ports[v["VM_NAME"]])]
+    write_if_changed(os.path.join(d, NGINX_PROXY_FRAGMENT),
+                     NGINX_PROXY_HEADER + "".join(servers))
+    write_if_changed(ports_path,
+                     json.dumps(ports, indent = 1, sort_keys = True) + "\n")
+
+    return [("etc_hosts_fragment", os.path.join(d, ETC_HOSTS_FRAGMENT)),
+            ("nginx_proxy_fragment", os.path.join(d, NGINX_PROXY_FRAGMENT))]
+
+def artifacts_exist(args):
+    d = args.artifacts_dir
+    return all(os.path.exists(os.path.join(d, f))
+               for f in (ETC_HOSTS_FRAGMENT, NGINX_PROXY_FRAGMENT, PROXY_PORTS))
+
+def generate_json(args):
+    """
+    Write the inventory (--list) or host vars of a host (--host) in JSON.
+    The inventory is cached for the same CSV content and args.
+    """
+    path = None if args.no_cache else cache_path(csv_digest(args), args)
+    content = read_cache(path) if path else None
+    if args.artifacts_dir and not artifacts_exist(args):
+        content = None
+
+    if content is None:
+        vms, projects = read_vms(args)
+        table = validate_vms(vms, args.enable_linklocal)
+        warn_overlaps(vms, table, projects)
+        all_vars, groups = build_inventory(vms, table, args, projects)
+        if args.artifacts_dir:
+            all_vars += write_artifacts(groups, args)
+        content = json.dumps(inventory_json(all_vars, groups, args))
+        if path:
+            write_cache(path, content)
+
+    if args.host is not None:
+        hostvars = json.loads(content)["_meta"]["hostvars"]
+        content = json.dumps(hostvars.get(args.host, {}))
+
+    args.output.write(content + "\n")
+
+def vm_table(vms):
+    """
+    Return {VM name: {address key: address}} of vms to compare runs
+    """
+    return {vm["VM_NAME"]: {k: v for k, v in vm.items() if "_IPv" in k}
+            for vm in vms}
+
+def read_state(path):
+    """
+    Read the VM table of the previous run; empty if there is none
+    """
+    try:
+        with open(path, encoding = "utf-8") as f:
+            return json.load(f)["vms"]
+    except FileNotFoundError:
+        return {}
+
+def get_delta(old, new):
+    """
+    Return names of added, removed and re-addressed VMs between
+    VM tables old and new
+    """
+    added = sorted(set(new) - set(old))
+    removed = sorted(set(old) - set(new))
+    readdressed = sorted(name for name in set(new) & set(old)
+                         if new[name] != old[name])
+    return added, removed, readdressed
+
+def write_if_changed(path, content):
+    """
+    Write content to path atomically unless it already has the content.
+    Return True if written.
+    """
+    try:
+        with open(path, encoding = "utf-8") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w", encoding = "utf-8") as f:
+        f.write(content)
+    os.replace(tmp, path)
+    return True
+
+def print_delta(vms, old, args):
+    """
+    Print VMs changed since the previous run (or hosts to --limit
+    playbooks to with --print-limit)
+    """
+    new = vm_table(vms)
+    added, removed, readdressed = get_delta(old, new)
+    addrs = {vm["VM_NAME"]: vm_address(vm, args) for vm in vms}
+
+    if args.print_limit:
+        hosts = [addrs[name] for name in added + readdressed if addrs[name]]
+        print(",".join(hosts))
+        return
+
+    for name in added:
+        print("added: {} ({})".format(name, addrs[name]))
+    for name in removed:
+        print("removed: {}".format(name))
+    for name in readdressed:
+        print("re-addressed: {} ({})".format(name, addrs[name]))
+    if not (added or removed or readdressed):
+        print("no VMs changed")
+
+def warn_overlaps(vms, table, projects):
+    for address, vm, other in overlapping_addresses(vms, table, projects):
+        warn("address {} of {} is also of {}".format(
+            address, other["VM_NAME"], vm["VM_NAME"]))
+
+def generate_inventory(args):
+
+    output = args.output
+    if output == "-":
+        args.output = sys.stdout
+    else:
+        args.output = io.StringIO()
+
+    if args.list or args.host is not None:
+        generate_json(args)
+    else:
+        vms, projects = read_vms(args)
+        table = validate_vms(vms, args.enable_linklocal)
+        warn_overlaps(vms, table, projects)
+
+        all_vars, groups = build_inventory(vms, table, args, projects)
+        if args.artifacts_dir:
+            all_vars += write_artifacts(groups, args)
+        write_ini(all_vars, groups, args)
+
+    if output != "-":
+        write_if_changed(output, args.output.getvalue())
+
+    if args.state:
+        print_delta(vms, read_state(args.state), args)
+        write_if_changed(args.state,
+                         json.dumps({"vms": vm_table(vms)}, indent = 1,
+                                    sort_keys = True) + "\n")
+
+
+def read_ini_groups(f):
+    """
+    Return {group: [host, ...]} of an INI inventory (as this script
+    writes), or None if f has what only Ansible can read (host
+    ranges, YAML, ...). Hosts of children groups are included.
+    """
+    groups = {"all": [], "ungrouped": []}
+    children = {}
+    section, kind = "ungrouped", "hosts"
+
+    for line in f:
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            section, _, kind = line[1:-1].partition(":")
+            kind = kind or "hosts"
+            if kind == "hosts":
+                groups.setdefault(section, [])
+            elif kind == "children":
+                children.setdefault(section, [])
+            elif kind != "vars":
+                return None
+            continue
+        if kind == "vars":
+            continue
+        name = line.split()[0]
+        if "[" in name or name.endswith(":") or name == "---":
+            return None
+        if kind == "children":
+            children[section].append(name)
+        else:
+            groups[section].append(name)
+
+    def hosts_of(group, visiting):
+        hosts = list(groups.get(group, []))
+        for child in children.get(group, []):
+            if child not in visiting:
+                hosts += hosts_of(child, visiting | {child})
+        return hosts
+
+    table = {}
+    for group in set(groups) | set(children):
+        table[group] = list(dict.fromkeys(hosts_of(group, {group})))
+    table["all"] = list(dict.fromkeys(host for group in groups
+                                      for host in groups[group]))
+    return table
+
+def load_inventory_groups(path):
+    """
+    Return {group: [host, ...]} of an INI inventory or of a portal CSV
+    (grouped with the default options of this script), without Ansible.
+    None if path is something else (e.g., a YAML inventory, a script
+    or a directory); use Ansible to read it then.
+    """
+    if (not os.path.isfile(path) or os.access(path, os.X_OK) or
+        path.endswith((".yml", ".yaml", ".json"))):
+        return None
+
+    with open(path, encoding = "utf_8_sig") as f:
+        first = f.readline()
+        f.seek(0)
+        if "VM_NAME" not in first:
+            return read_ini_groups(f)
+
+        args = parse_args([path])
+        for csv_file in args.csv:
+            csv_file.close()
+        vms = csv2dictlist(f)
+
+    vms.sort(key = lambda x: x["VM_NAME"])
+    table = validate_vms(vms, args.enable_linklocal)
+    _, groups = build_inventory(vms, table, args)
+
+    hosts = {}
+    for groupname, _, members in groups:
+        hosts.setdefault(groupname, []).extend(
+            addr for addr in map(lambda vm: vm_address(vm, args), members)
+            if addr)
+    hosts["all"] = hosts[args.default_group]
+    return {g: list(dict.fromkeys(h)) for g, h in hosts.items()}
+
+def parse_args(argv = None):
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("csv",
+    parser.add_argument("csv", nargs = "+",
                         type = argparse.FileType("r", encoding = "utf_8_sig"),
-                        help = "CSV file generated by mdx user portal")
+                        help = ("CSV files generated by mdx user portal " +
+                                "(of one or more projects)"))
 
     parser.add_argument("-6", "--use-ipv6", action = "store_true",
                         help = "use IPv6 address for hosts")
@@ -222,18 +962,98 @@ def main():
     parser.add_argument("--group-without", nargs = "+", action = "append",
                         metavar = ("GROUP", "VM_NAME"),
                         help = "make a group without specified VM names ")
+    parser.add_argument("--batch-size", type = int, metavar = "N",
+                        help = ("make groups batch_0, batch_1, ... " +
+                                "of N VMs each for rolling updates"))
+    parser.add_argument("--batch-prefix", default = "batch_",
+                        help = "name prefix of batch groups, default is batch_")
+    parser.add_argument("--subnet-groups", type = int, metavar = "PREFIXLEN",
+                        help = ("make a group per PREFIXLEN-bit subnet " +
+                                "of the RDMA networks (e.g., rdma_10_12_0_0_24)"))
+    parser.add_argument("--project-groups", action = "store_true",
+                        help = ("make a group of the VMs of each CSV, " +
+                                "named after the file (e.g., project_a " +
+                                "for a.csv)"))
+    parser.add_argument("--project-prefix", default = "project_",
+                        help = ("name prefix of project groups, " +
+                                "default is project_"))
+    parser.add_argument("--ipv4-prefixlen", type = int, default = 21,
+                        metavar = "PREFIXLEN",
+                        help = ("prefix length of the IPv4 networks of " +
+                                "VMs in ethipv4prefix/rdmaipv4prefix (NFS " +
+                                "exports), default is 21"))
+    parser.add_argument("--ipv6-prefixlen", type = int, default = 64,
+                        metavar = "PREFIXLEN",
+                        help = ("prefix length of the IPv6 networks of " +
+                                "VMs in ethipv6prefix, default is 64"))
     parser.add_argument("--per-node-groups", action = "store_true",
                         help = "make per-node groups in the inventory")
     parser.add_argument("--enable-ethipv6", action = "store_true",
                         help = "enable host var 'ethipv6'")
     parser.add_argument("--enable-linklocal", action = "store_true",
                         help = "enable IPv6 link locak address on inventory")
-    parser.add_argument("--output", type = argparse.FileType("w"),
-                        default = sys.stdout,
-                        help = "output file name, default is STDOUT")
+    parser.add_argument("--artifacts-dir", metavar = "DIR",
+                        help = ("write /etc/hosts entries and the reverse " +
+                                "proxy configuration of the groups below " +
+                                "to DIR for the common and reverse_proxy " +
+                                "roles"))
+    parser.add_argument("--etc-hosts-group", default = "default",
+                        metavar = "GROUP",
+                        help = ("group written to /etc/hosts with " +
+                                "--artifacts-dir (etc_host_group of the " +
+                                "common role), default is default"))
+    parser.add_argument("--jupyter-host-group", default = "default",
+                        metavar = "GROUP",
+                        help = ("group proxied by the reverse proxy with " +
+                                "--artifacts-dir (jupyter_host_group in " +
+                                "vars/reverse_proxy.yml), default is default"))
+    parser.add_argument("--list", action = "store_true",
+                        help = ("write the inventory in JSON " +
+                                "(as an Ansible inventory script)"))
+    parser.add_argument("--host",
+                        help = "write host vars of HOST in JSON")
+    parser.add_argument("--cache-dir",
+                        default = os.path.join(
+                            os.environ.get("XDG_CACHE_HOME",
+                                           os.path.expanduser("~/.cache")),
+                            "mdxcsv2inventory"),
+                        help = ("directory to cache JSON inventories, " +
+                                "default is ~/.cache/mdxcsv2inventory"))
+    parser.add_argument("--no-cache", action = "store_true",
+                        help = "do not use the cache of JSON inventories")
+    parser.add_argument("--output", default = "-",
+                        help = ("output file name, default is STDOUT; " +
+                                "the file is replaced only if it changes"))
+    parser.add_argument("--state",
+                        help = ("file to keep VMs of the previous run and " +
+                                "print VMs added, removed and re-addressed " +
+                                "since then (needs --output)"))
+    parser.add_argument("--print-limit", action = "store_true",
+                        help = ("with --state, print only hosts added or " +
+                                "re-addressed, for ansible-playbook --limit"))
+
+    args = parser.parse_args(argv)
+    args.projects = project_names(args.csv)
+
+    if args.batch_size is not None and args.batch_size < 1:
+        parser.error("--batch-size must be positive")
+    if args.subnet_groups is not None and not 0 <= args.subnet_groups <= 32:
+        parser.error("--subnet-groups must be between 0 and 32")
+    if not 0 <= args.ipv4_prefixlen <= 32:
+        parser.error("--ipv4-prefixlen must be between 0 and 32")
+    if not 0 <= args.ipv6_prefixlen <= 128:
+        parser.error("--ipv6-prefixlen must be between 0 and 128")
+    if args.state and (args.output == "-" or args.list or args.host):
+        parser.error("--state needs --output FILE and the INI inventory")
+    if args.print_limit and not args.state:
+        parser.error("--print-limit needs --state")
 
-    args = parser.parse_args()
+    return args
+
+
+def main():
 
+    args = parse_args()
     generate_inventory(args)
 
 
@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import errno
 import getpass
-import pexpect
-import multiprocessing as mp
+import json
+import os
+import shlex
 import sys
+import time
 
+from mdxcsv2inventory import load_inventory_groups, write_if_changed
 
-from ansible.parsing.dataloader import DataLoader
-from ansible.inventory.manager import InventoryManager
+# outcomes of a host
+SUCCESS = "success"
+INITIALIZED = "already initialized"
+UNREACHABLE = "unreachable"
+TIMEOUT = "timeout"
+FAILED = "failed"
+
+# hosts with these outcomes are skipped on a rerun with --state
+DONE = (SUCCESS, INITIALIZED)
+
+# ssh errors of a VM still booting (or not running)
+UNREACHABLE_ERRORS = ("Connection refused", "No route to host",
+                      "Connection timed out", "Network is unreachable",
+                      "Could not resolve hostname", "Connection reset",
+                      "Connection closed by", "kex_exchange_identification")
+
+MAX_BACKOFF = 60
 
 def pr_exit(string):
     print(string, file = sys.stderr)
@@ -16,6 +36,26 @@ def pr_exit(string):
 
 
 def load_hosts_from_inventory(args):
+    """
+    Return hosts of args.group read from an INI inventory or a portal CSV
+    directly, or with Ansible for other inventories
+    """
+    groups = load_inventory_groups(args.inventory)
+    if groups is None:
+        return load_hosts_with_ansible(args)
+
+    if not args.group in groups:
+        pr_exit("no group '{}' found in '{}'".format(args.group,
+                                                     args.inventory))
+
+    return groups[args.group]
+
+
+def load_hosts_with_ansible(args):
+
+    # importing ansible takes a while; only for inventories needing it
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.inventory.manager import InventoryManager
 
     loader = DataLoader()
     inventory = InventoryManager(loader = loader, sources = args.inventory)
@@ -27,31 +67,205 @@ def load_hosts_from_inventory(args):
     return list(map(str, inventory.groups[args.group].serialize()["hosts"]))
 
 
-def set_first_password(mparg):
+class PtyProcess:
+    """
+    A command running on a pseudo terminal, whose output is read
+    asynchronously to wait for prompts (what pexpect does, on asyncio)
+    """
+    def __init__(self, proc, master):
+        self.proc = proc
+        self.master = master
+        self.buffer = ""
+        self.eof = False
+        self.changed = asyncio.Event()
+        asyncio.get_running_loop().add_reader(master, self.read)
+
+    @classmethod
+    async def spawn(cls, cmd):
+        master, slave = os.openpty()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *shlex.split(cmd), stdin = slave, stdout = slave,
+                stderr = slave, start_new_session = True)
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        os.set_blocking(master, False)
+        return cls(proc, master)
+
+    def read(self):
+        try:
+            data = os.read(self.master, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # EIO when the command exits and the slave is closed
+            if e.errno != errno.EIO:
+                raise
+            data = b""
+        if not data:
+            self.eof = True
+            asyncio.get_running_loop().remove_reader(self.master)
+        self.buffer += data.decode("utf-8", "replace")
+        self.changed.set()
+
+    def find(self, patterns):
+        """
+        Return the pattern output first and its position, or (None, -1)
+        """
+        found = [(self.buffer.find(p), p) for p in patterns]
+        found = [(pos, p) for pos, p in found if pos >= 0]
+        if not found:
+            return None, -1
+        pos, pattern = min(found)
+        return pattern, pos
+
+    async def expect(self, pattern, timeout):
+        """
+        Wait until pattern (or one of patterns if it is a tuple) is
+        output, drop the output up to it and return the pattern found
+        """
+        patterns = pattern if isinstance(pattern, tuple) else (pattern,)
+        pattern = "' or '".join(patterns)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            found, pos = self.find(patterns)
+            if found is not None:
+                break
+            if self.eof:
+                raise EOFError("connection closed waiting for '{}', "
+                               "last output: {!r}".format(pattern,
+                                                          self.buffer[-100:]))
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(),
+                                       deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise TimeoutError("timeout waiting for '{}', "
+                                   "last output: {!r}".format(pattern,
+                                                              self.buffer[-100:]))
+        self.buffer = self.buffer[pos + len(found):]
+        return found
 
-    (args, host) = mparg
+    def sendline(self, line):
+        os.write(self.master, (line + "\n").encode("utf-8"))
 
+    async def close(self):
+        if not self.eof:
+            asyncio.get_running_loop().remove_reader(self.master)
+        if self.proc.returncode is None:
+            self.proc.kill()
+        await self.proc.wait()
+        os.close(self.master)
+
+
+async def set_first_password(args, password, host):
+    """
+    Initialize the password of host once. Return (host, outcome, detail)
+    """
     ssh_args = ("-o StrictHostKeyChecking=no " +
                 "-o UserKnownHostsFile=/dev/null " +
-                "-o PreferredAuthentications=publickey")
+                "-o PreferredAuthentications=publickey " +
+                "-o ConnectTimeout={}".format(args.timeout))
     cmd = "ssh {} {} -l {} {}".format(ssh_args, args.ssh_args, args.user, host)
 
-    conn = pexpect.spawn(cmd, timeout = args.timeout)
+    try:
+        conn = await PtyProcess.spawn(cmd)
+    except OSError as e:
+        return (host, FAILED, str(e))
+
+    try:
+        # logged in without being asked for a new password: done before
+        found = await conn.expect(("New password: ", args.prompt),
+                                  args.timeout)
+        if found != "New password: ":
+            return (host, INITIALIZED, "")
+        conn.sendline(password)
+        await conn.expect("Retype new password: ", args.timeout)
+        conn.sendline(password)
+        await conn.expect("passwd: password updated successfully",
+                          args.timeout)
+    except EOFError as e:
+        if any(err in str(e) for err in UNREACHABLE_ERRORS):
+            return (host, UNREACHABLE, str(e))
+        return (host, FAILED, str(e))
+    except TimeoutError as e:
+        return (host, TIMEOUT, str(e))
+    finally:
+        await conn.close()
+
+    return (host, SUCCESS, "")
 
-    ret = "Success"
 
+def read_state(path):
+    """
+    Return {host: {"outcome": ..., ...}} saved in the state file at path
+    """
+    if not path:
+        return {}
     try:
-        conn.expect("New password: ")
-        conn.sendline(args.password)
-        conn.expect("Retype new password: ")
-        conn.sendline(args.password)
-        conn.expect("passwd: password updated successfully")
-    except Exception as e:
-        for line in str(e).split("\n"):
-            if "buffer (last 100 chars)" in line:
-                ret = line
-        
-    return (host, ret)
+        with open(path, encoding = "utf-8") as f:
+            return json.load(f).get("hosts", {})
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        pr_exit("broken state file '{}': {}".format(path, e))
+
+
+def write_state(path, state):
+    if path:
+        write_if_changed(path, json.dumps({"hosts": state}, indent = 1,
+                                          sort_keys = True) + "\n")
+
+
+async def set_first_passwords(args, password, hosts, state = None):
+    """
+    Initialize passwords of hosts, at most args.forks at a time,
+    printing the result of each host as it finishes. Unreachable hosts
+    (e.g., still booting) are retried up to args.retries times with
+    exponential backoff. Outcomes are recorded in state (and the state
+    file args.state) as they are known.
+    """
+    state = {} if state is None else state
+    sem = asyncio.Semaphore(args.forks)
+
+    async def one(host):
+        delay = args.backoff
+        for attempt in range(1, args.retries + 2):
+            async with sem:
+                host, outcome, detail = await set_first_password(
+                    args, password, host)
+            if outcome != UNREACHABLE or attempt > args.retries:
+                return host, outcome, detail, attempt
+            print("{}: {}, retrying in {}s".format(host, outcome, delay),
+                  flush = True)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    rets = []
+    for task in asyncio.as_completed([one(host) for host in hosts]):
+        host, outcome, detail, attempts = await task
+        if detail:
+            print("{}: {} ({})".format(host, outcome, detail), flush = True)
+        else:
+            print("{}: {}".format(host, outcome), flush = True)
+        state[host] = {"outcome": outcome, "detail": detail,
+                       "attempts": attempts,
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        write_state(args.state, state)
+        rets.append((host, outcome))
+    return rets
+
+
+def print_summary(rets):
+    counts = {}
+    for _, outcome in rets:
+        counts[outcome] = counts.get(outcome, 0) + 1
+    print(", ".join("{}: {}".format(outcome, n)
+                    for outcome, n in sorted(counts.items())))
 
 
 def main():
@@ -61,25 +275,56 @@ def main():
     parser = argparse.ArgumentParser(description = desc)
     parser.add_argument("inventory",
                         metavar = "INVENTORY",
-                        help = "ansible inventory file")
+                        help = ("ansible inventory file, or CSV file " +
+                                "generated by mdx user portal"))
     parser.add_argument("-u", "--user", default = "mdxuser",
                         help = "ssh login user, default is 'mdxuser'")
     parser.add_argument("-g", "--group", default = "default",
                         help = ("group of VMs in the inventory to " +
                                 "initialize passowrd, default is 'default'"))
-    parser.add_argument("-t", "--timeout", default = 5,
+    parser.add_argument("-t", "--timeout", type = int, default = 5,
                         help = "timeout to ssh and wait 'New password:'")
-    parser.add_argument("--f", "--forks", default = 30,
-                        help = "number of fork processes, default is 30")
+    parser.add_argument("--f", "--forks", dest = "forks", type = int,
+                        default = 30,
+                        help = ("number of hosts initialized at a time, " +
+                                "default is 30"))
     parser.add_argument("--ssh-args", default = "",
                         help = "arguments for ssh to VMs")
-    
+    parser.add_argument("--prompt", default = "$ ",
+                        help = ("shell prompt meaning the password was " +
+                                "already initialized, default is '$ '"))
+    parser.add_argument("--retries", type = int, default = 5,
+                        help = ("times to retry unreachable hosts, " +
+                                "default is 5"))
+    parser.add_argument("--backoff", type = float, default = 5,
+                        help = ("seconds to wait before the first retry, " +
+                                "doubled at each retry (up to {}), " +
+                                "default is 5").format(MAX_BACKOFF))
+    parser.add_argument("--state",
+                        help = ("file to record the outcome of each host; " +
+                                "hosts already initialized are skipped " +
+                                "on a rerun"))
+    parser.add_argument("--force", action = "store_true",
+                        help = "with --state, do not skip any host")
+
     args = parser.parse_args()
 
     hosts = load_hosts_from_inventory(args)
     if not hosts:
         pr_exit("No host found in gorup '{}' in '{}'".format(args.group,
                                                              args.inventory))
+
+    state = read_state(args.state)
+    if not args.force:
+        done = [host for host in hosts
+                if state.get(host, {}).get("outcome") in DONE]
+        if done:
+            print("Skipped hosts (initialized before): {}".format(
+                ", ".join(done)))
+        hosts = [host for host in hosts if host not in set(done)]
+        if not hosts:
+            print("All hosts are initialized")
+            return
     print("Target hosts: {}".format(", ".join(hosts)))
 
     password = getpass.getpass(prompt = "New Password: ")
@@ -87,20 +332,11 @@ def main():
     if password != verify:
         pr_exit("Password mismatch")
 
-    setattr(args, "password", password)
-
-
     print("initializing the first password...")
-    mpargs = []
-    for host in hosts:
-        mpargs.append((args, host))
-
-    with mp.Pool(processes = 30) as p:
-        rets = p.map(set_first_password, mpargs)
-
-    for ret in rets:
-        print("{}: {}".format(ret[0], ret[1]))
-
+    rets = asyncio.run(set_first_passwords(args, password, hosts, state))
+    print_summary(rets)
+    if any(outcome not in DONE for _, outcome in rets):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -4,12 +4,181 @@
 ldap_adduser
 """
 
+import atexit
+import base64
+import bisect
+import concurrent.futures
+import contextlib
+import csv
+import functools
 import getpass
+import hashlib
+import inspect
+import json
 import os
 import re
+import secrets
+import shlex
+import shutil
+import stat
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 
-def run(cmd, info, check=False, **kw):
+try:
+    import ldap                 # python3-ldap
+    import ldap.controls
+except ImportError:
+    ldap = None
+
+# LDAP result codes we report ourselves
+LDAP_SUCCESS = 0
+LDAP_OTHER = 80
+LDAP_NO_SUCH_ATTRIBUTE = 16
+LDAP_TYPE_OR_VALUE_EXISTS = 20
+LDAP_NO_SUCH_OBJECT = 32
+LDAP_NOT_ALLOWED_ON_NONLEAF = 66
+LDAP_ALREADY_EXISTS = 68
+
+#
+# profiling: time and number of operations by kind, processes spawned
+# and requests sent to the server
+#
+
+class Profile:
+    """
+    statistics of operations of a run.  an operation called within
+    another (e.g., search by exists) is part of the outer one
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.monotonic()
+        self.ops = {}           # kind -> [count, seconds]
+        self.spawns = 0
+        self.round_trips = 0
+
+    def add(self, kind, count, seconds):
+        """
+        add count operations of kind taking seconds
+        """
+        with self.lock:
+            stat = self.ops.setdefault(kind, [0, 0.0])
+            stat[0] += count
+            stat[1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, kind, count=1):
+        """
+        count the with block as count operations of kind
+        """
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if depth == 0:
+                self.add(kind, count, time.monotonic() - start)
+
+    def spawned(self, round_trips=1):
+        """
+        a process (an LDAP command making round_trips requests) was spawned
+        """
+        with self.lock:
+            self.spawns += 1
+            self.round_trips += round_trips
+
+    def round_trip(self):
+        """
+        a request (other than bind) was sent to the server
+        """
+        with self.lock:
+            self.round_trips += 1
+
+    def summary(self):
+        """
+        the statistics as a dictionary (seconds of operations run in
+        threads are summed)
+        """
+        return {"seconds" : round(time.monotonic() - self.start, 6),
+                "spawns" : self.spawns,
+                "round_trips" : self.round_trips,
+                "ops" : {kind : {"count" : count, "seconds" : round(sec, 6)}
+                         for kind, (count, sec) in sorted(self.ops.items())}}
+
+PROFILE = Profile()
+
+def profiled(kind):
+    """
+    decorator counting calls of a function (or a generator, timed
+    while it runs) as operations of kind
+    """
+    def decorate(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def gen_wrapper(*args, **kw):
+                gen = func(*args, **kw)
+                PROFILE.add(kind, 1, 0.0)
+                while True:
+                    with PROFILE.timed(kind, count=0):
+                        try:
+                            item = next(gen)
+                        except StopIteration:
+                            return
+                    yield item
+            return gen_wrapper
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            with PROFILE.timed(kind):
+                return func(*args, **kw)
+        return wrapper
+    return decorate
+
+SECRET_OPTS = ("ldap_passwd", "password", "password_hash")
+
+def redact(text, info):
+    """
+    text with the LDAP admin password in info masked
+    """
+    passwd = info.get("ldap_passwd")
+    if not passwd:
+        return text
+    with contextlib.suppress(OSError):
+        passwd = resolve_ldap_passwd(passwd)
+    return text.replace(f"-w {shlex.quote(passwd)}", "-w ***")
+
+def write_profile(info, tool):
+    """
+    write the profile of this run of tool to info["profile"] in JSON,
+    with the options (credentials redacted) it ran with
+    """
+    path = info.get("profile")
+    if not path:
+        return
+    opts = {}
+    for key, val in sorted(info.items()):
+        if key in SECRET_OPTS:
+            val = None if val is None else "***"
+        elif not isinstance(val, (str, int, float, bool, list, type(None))):
+            continue
+        opts[key] = val
+    prof = {"tool" : tool,
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "backend" : type(info.get("conn")).__name__,
+            "options" : opts}
+    prof.update(PROFILE.summary())
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as prof_wp:
+        json.dump(prof, prof_wp, indent=1)
+        prof_wp.write("\n")
+    os.replace(tmp, path)
+
+def run(cmd, info, check=False, round_trips=1, **kw):
     """
     run a command
     """
@@ -18,23 +187,142 @@ def run(cmd, info, check=False, **kw):
                 "capture_output" : True}
     run_opts.update(kw)
     if info["verbose"]:
-        print(f"cmd: {cmd}", flush=True)
-    if info["run"]:
-        comp = subprocess.run(cmd, check=check, **run_opts)
-    else:
-        comp = subprocess.run("true")
-    return comp
+        print(f"cmd: {redact(cmd, info)}", flush=True)
+    if not info["run"]:
+        return subprocess.CompletedProcess(cmd, 0, "", "")
+    PROFILE.spawned(round_trips)
+    return subprocess.run(cmd, check=check, **run_opts)
+
+#
+# password hashes, computed in-process in the formats slapd verifies
+#
+
+PASSWORD_SCHEMES = ("SSHA", "CRYPT")
+
+CRYPT_ALPHABET = "./0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+
+# byte order of the SHA-512 crypt result encoding
+SHA512_CRYPT_ORDER = ((0, 21, 42), (22, 43, 1), (44, 2, 23), (3, 24, 45),
+                      (25, 46, 4), (47, 5, 26), (6, 27, 48), (28, 49, 7),
+                      (50, 8, 29), (9, 30, 51), (31, 52, 10), (53, 11, 32),
+                      (12, 33, 54), (34, 55, 13), (56, 14, 35), (15, 36, 57),
+                      (37, 58, 16), (59, 17, 38), (18, 39, 60), (40, 61, 19),
+                      (62, 20, 41))
+
+def ssha(passwd, salt=None):
+    """
+    {SSHA} hash of passwd, same as slappasswd -h {SSHA}
+    """
+    if salt is None:
+        salt = os.urandom(4)
+    digest = hashlib.sha1(passwd.encode("utf-8") + salt).digest()
+    return "{SSHA}" + base64.b64encode(digest + salt).decode("ascii")
+
+def sha512_crypt(passwd, salt=None, rounds=5000):
+    """
+    SHA-512 crypt(3) ($6$) hash of passwd
+    """
+    if salt is None:
+        salt = "".join(secrets.choice(CRYPT_ALPHABET) for _ in range(16))
+    pw = passwd.encode("utf-8")
+    sl = salt.encode("ascii")[:16]
+    dig_b = hashlib.sha512(pw + sl + pw).digest()
+    ctx = hashlib.sha512(pw + sl)
+    n = len(pw)
+    while n > 64:
+        ctx.update(dig_b)
+        n -= 64
+    ctx.update(dig_b[:n])
+    n = len(pw)
+    while n > 0:
+        ctx.update(dig_b if n & 1 else pw)
+        n >>= 1
+    dig_a = ctx.digest()
+    seq_p = (hashlib.sha512(pw * len(pw)).digest() * (len(pw) // 64 + 1))[:len(pw)]
+    seq_s = (hashlib.sha512(sl * (16 + dig_a[0])).digest() * (len(sl) // 64 + 1))[:len(sl)]
+    dig_c = dig_a
+    for i in range(rounds):
+        ctx = hashlib.sha512(seq_p if i & 1 else dig_c)
+        if i % 3:
+            ctx.update(seq_s)
+        if i % 7:
+            ctx.update(seq_p)
+        ctx.update(dig_c if i & 1 else seq_p)
+        dig_c = ctx.digest()
+    out = []
+    for triple, n_chars in [(t, 4) for t in SHA512_CRYPT_ORDER] + [((None, None, 63), 2)]:
+        word = 0
+        for idx in triple:
+            word = (word << 8) | (dig_c[idx] if idx is not None else 0)
+        for _ in range(n_chars):
+            out.append(CRYPT_ALPHABET[word & 0x3f])
+            word >>= 6
+    prefix = "$6$" if rounds == 5000 else f"$6$rounds={rounds}$"
+    return f'{prefix}{sl.decode("ascii")}${"".join(out)}'
+
+@profiled("hash")
+def hash_password(passwd, scheme="SSHA"):
+    """
+    hash passwd for userPassword ({SSHA} or {CRYPT} SHA-512)
+    """
+    if scheme == "CRYPT":
+        return "{CRYPT}" + sha512_crypt(passwd)
+    return ssha(passwd)
+
+# pools of processes hashing passwords, one per number of workers,
+# kept for the whole run as hashes are computed a chunk at a time
+HASH_POOLS = {}
+
+def hash_pool(workers):
+    """
+    the process pool of workers hashing passwords
+    """
+    if workers not in HASH_POOLS:
+        if not HASH_POOLS:
+            atexit.register(close_hash_pools)
+        HASH_POOLS[workers] = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        for _ in range(workers):
+            PROFILE.spawned(round_trips=0)
+    return HASH_POOLS[workers]
+
+def close_hash_pools():
+    """
+    shut down the pools made by hash_pool
+    """
+    for pool in HASH_POOLS.values():
+        pool.shutdown()
+    HASH_POOLS.clear()
+
+def hash_passwords(passwds, scheme="SSHA", workers=1):
+    """
+    hash many passwords, with a pool of worker processes if workers > 1.
+    {SSHA} (one SHA-1) is always hashed in-process; a pool pays off only
+    for SHA-512 {CRYPT}
+    """
+    func = functools.partial(hash_password, scheme=scheme)
+    with PROFILE.timed("hash", count=len(passwds)):
+        if scheme != "CRYPT" or workers <= 1 or len(passwds) < 2 * workers:
+            return [func(passwd) for passwd in passwds]
+        chunk = max(1, len(passwds) // (workers * 4))
+        return list(hash_pool(workers).map(func, passwds, chunksize=chunk))
+
+def hash_passwords_of_rows(rows, info):
+    """
+    set password_hash of rows that have only a plain password
+    """
+    todo = [row for row in rows
+            if row.get("password_hash", "") == "" and row.get("password", "") != ""]
+    hashes = hash_passwords([row["password"] for row in todo],
+                            info.get("password_scheme") or "SSHA",
+                            info.get("hash_workers") or 1)
+    for row, password_hash in zip(todo, hashes):
+        row["password_hash"] = password_hash
 
 def slappasswd(passwd, info):
     """
     generate passwd hash
     """
-    cmd = f"slappasswd -s {passwd}"
-    try:
-        comp = run(cmd, info, check=True)
-    except FileNotFoundError:
-        return None
-    return comp.stdout.strip()
+    return hash_password(passwd, info.get("password_scheme") or "SSHA")
 
 def ask_password(user):
     """
@@ -42,27 +330,1005 @@ def ask_password(user):
     """
     return getpass.getpass(f"Password for {user}: ")
 
+#
+# LDIF
+#
+
+def unfold_ldif(ldif):
+    """
+    join continuation lines of LDIF text and drop comments
+    """
+    lines = []
+    for line in ldif.split("\n"):
+        line = line.rstrip("\r")
+        if line.startswith(" ") and lines and lines[-1] != "":
+            lines[-1] += line[1:]
+        elif line.startswith("#"):
+            continue
+        else:
+            lines.append(line)
+    return lines
+
+def parse_ldif_line(line):
+    """
+    split an LDIF line "attr: val" or "attr:: base64" into (attr, val)
+    """
+    attr, sep, val = line.partition(":")
+    if not sep:
+        return line.strip(), ""
+    if val.startswith(":"):
+        val = base64.b64decode(val[1:].strip()).decode("utf-8")
+    else:
+        val = val.strip()
+    return attr.strip(), val
+
+def parse_ldif(ldif):
+    """
+    parse LDIF text into a list of records.
+    a record is a dict having "dn", "changetype" and either
+    "attrs" ({attr : [val, ...]}, for add) or
+    "mods" ([(op, attr, [val, ...]), ...], for modify)
+    """
+    records = []
+    block = []
+    for line in unfold_ldif(ldif or "") + [""]:
+        if line != "":
+            block.append(line)
+            continue
+        if block:
+            record = parse_ldif_record(block)
+            if record is not None:
+                records.append(record)
+        block = []
+    return records
+
+def parse_ldif_record(block):
+    """
+    parse lines of a single LDIF record
+    """
+    pairs = [parse_ldif_line(line) if line != "-" else ("-", "")
+             for line in block]
+    if pairs and pairs[0][0] == "version":
+        pairs = pairs[1:]
+    if not pairs or pairs[0][0].lower() != "dn":
+        return None
+    record = {"dn" : pairs[0][1], "changetype" : "add"}
+    pairs = pairs[1:]
+    if pairs and pairs[0][0].lower() == "changetype":
+        record["changetype"] = pairs[0][1].lower()
+        pairs = pairs[1:]
+    if record["changetype"] == "modify":
+        mods = []
+        for attr, val in pairs:
+            if attr == "-":
+                continue
+            if attr.lower() in ("add", "delete", "replace"):
+                mods.append((attr.lower(), val, []))
+            elif mods:
+                mods[-1][2].append(val)
+        record["mods"] = mods
+    else:
+        attrs = {}
+        for attr, val in pairs:
+            attrs.setdefault(attr, []).append(val)
+        record["attrs"] = attrs
+    return record
+
+def ldif_value_line(attr, val):
+    """
+    make an LDIF line for attr: val, base64-encoding it if necessary
+    """
+    if (val == "" or val[0] in " :<" or val[-1] == " "
+            or any(c in val for c in "\r\n\0") or not val.isascii()):
+        enc = base64.b64encode(val.encode("utf-8")).decode("ascii")
+        return f"{attr}:: {enc}"
+    return f"{attr}: {val}"
+
+def format_ldif(entries):
+    """
+    make LDIF text of entries [(dn, {attr : [val, ...]}), ...]
+    """
+    chunks = []
+    for dn, attrs in entries:
+        lines = [ldif_value_line("dn", dn)]
+        for attr, vals in attrs.items():
+            for val in vals:
+                lines.append(ldif_value_line(attr, val))
+        chunks.append("\n".join(lines) + "\n")
+    return "\n".join(chunks)
+
+def parse_rejects(text):
+    """
+    parse the file written by ldapadd -S into [(dn, error message), ...]
+    """
+    rejected = []
+    for block in text.split("\n\n"):
+        msg = ""
+        for line in block.split("\n"):
+            if line.startswith("# Error: "):
+                msg = line[len("# Error: "):]
+        records = parse_ldif(block)
+        if records:
+            rejected.append((records[0]["dn"], msg))
+    return rejected
+
+def match_rejects(ldifs, rejected):
+    """
+    find which of ldifs were rejected ([(dn, error message), ...]).
+    return {index : error message}
+    """
+    positions = {}
+    for i, ldif in enumerate(ldifs):
+        for rec in parse_ldif(ldif):
+            positions.setdefault(dn_key(rec["dn"]), []).append(i)
+    failed = {}
+    for dn, msg in rejected:
+        indexes = positions.get(dn_key(dn))
+        if indexes:
+            failed[indexes.pop(0)] = msg
+    return failed
+
+#
+# connections to the LDAP server.
+# a connection is kept in info["conn"] and all directory operations
+# go through it.  every backend has the same methods:
+#   search(base, filt, attrs, scope) -> (result code, [(dn, attrs), ...])
+#   exists(dn), add(ldif), modify(ldif), delete(dn) -> result code
+#   apply_many([ldif, ...]) -> {index : error message} of failed records
+#   search_paged(base, filt, attrs, page_size) -> yields (dn, attrs),
+#     fetching page_size entries at a time; raises SearchError on failure
+#
+
+SCOPES = ("base", "one", "sub")
+
+class SearchError(Exception):
+    """
+    a paged search failed; args[0] is the result code
+    """
+
+def iter_ldif_records(lines):
+    """
+    parse LDIF records from an iterable of lines as they arrive
+    """
+    block = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line != "":
+            block.append(line)
+            continue
+        if block:
+            yield from parse_ldif("\n".join(block))
+        block = []
+    if block:
+        yield from parse_ldif("\n".join(block))
+
+class SubprocessConn:
+    """
+    run ldapsearch/ldapadd/ldapmodify/ldapdelete for each operation
+    """
+    # every command is a session of its own
+    shareable = True
+
+    def __init__(self, info):
+        self.info = info
+        # the password is read here once; "-w $(cat /etc/ldap.secret)"
+        # would fork a cat for every command
+        passwd = resolve_ldap_passwd(info["ldap_passwd"]) if info["run"] else "***"
+        self.auth = f'-x -w {shlex.quote(passwd)} -D cn=admin,{info["ldap_domain"]}'
+        if info.get("ldap_uri"):
+            self.auth += f' -H {info["ldap_uri"]}'
+
+    def report(self, comp):
+        """
+        show what a failed command said
+        """
+        if comp.returncode != 0 and comp.stderr:
+            print(comp.stderr.strip())
+
+    @profiled("search")
+    def search(self, base, filt="(objectClass=*)", attrs=(), scope="sub"):
+        """
+        search the subtree of base
+        """
+        cmd = (f"ldapsearch {self.auth} -LLL -b {shlex.quote(base)}"
+               f" -s {scope} {shlex.quote(filt)} {' '.join(attrs)}")
+        comp = run(cmd, self.info)
+        if comp.returncode != 0:
+            return comp.returncode, []
+        return 0, [(rec["dn"], rec["attrs"])
+                   for rec in parse_ldif(comp.stdout)]
+
+    @profiled("search")
+    def search_paged(self, base, filt="(objectClass=*)", attrs=(), page_size=500):
+        """
+        search the subtree of base with the paged results control,
+        parsing ldapsearch output as it streams in
+        """
+        cmd = (f"ldapsearch {self.auth} -LLL -E pr={page_size}/noprompt"
+               f" -b {shlex.quote(base)} {shlex.quote(filt)} {' '.join(attrs)}")
+        if self.info["verbose"]:
+            print(f"cmd: {redact(cmd, self.info)}", flush=True)
+        if not self.info["run"]:
+            return
+        PROFILE.spawned()
+        with subprocess.Popen(cmd, shell=True, encoding="utf-8",
+                              stdout=subprocess.PIPE) as proc:
+            for rec in iter_ldif_records(proc.stdout):
+                yield rec["dn"], rec["attrs"]
+        if proc.returncode != 0:
+            raise SearchError(proc.returncode)
+
+    @profiled("search")
+    def exists(self, dn):
+        """
+        check if dn exists
+        """
+        return self.search(dn, attrs=("1.1",), scope="base")[0] == 0
+
+    @profiled("add")
+    def add(self, ldif):
+        """
+        add entries in ldif
+        """
+        comp = run(f"ldapadd {self.auth}", self.info, input=ldif)
+        self.report(comp)
+        return comp.returncode
+
+    @profiled("modify")
+    def modify(self, ldif):
+        """
+        apply changes in ldif
+        """
+        comp = run(f"ldapmodify {self.auth}", self.info, input=ldif)
+        self.report(comp)
+        return comp.returncode
+
+    @profiled("delete")
+    def delete(self, dn):
+        """
+        delete dn
+        """
+        comp = run(f"ldapdelete {self.auth} {shlex.quote(dn)}", self.info)
+        self.report(comp)
+        return comp.returncode
+
+    @profiled("batch")
+    def apply_many(self, ldifs):
+        """
+        apply many records with a single ldapadd -c; records the server
+        rejected are read back from the file given to -S
+        """
+        if not ldifs:
+            return {}
+        with tempfile.NamedTemporaryFile("r", encoding="utf-8",
+                                         prefix="ldaptool", suffix=".rej") as rej_fp:
+            comp = run(f"ldapadd -c -S {rej_fp.name} {self.auth}", self.info,
+                       round_trips=len(ldifs), input="\n".join(ldifs))
+            rejected = parse_rejects(rej_fp.read())
+        if comp.returncode != 0 and not rejected:
+            # failed before applying anything (e.g., cannot bind)
+            self.report(comp)
+            return {i : f"ldapadd failed ({comp.returncode})" for i in range(len(ldifs))}
+        return match_rejects(ldifs, rejected)
+
+    def close(self):
+        """
+        nothing to do; every command made its own connection
+        """
+
+def decode_attrs(attrs):
+    """
+    {attr : [bytes, ...]} from python-ldap -> {attr : [str, ...]}
+    """
+    return {attr : [v.decode("utf-8", "replace") for v in vals]
+            for attr, vals in attrs.items()}
+
+class LdapConn:
+    """
+    a connection bound once and reused for all operations (python3-ldap)
+    """
+    # a session is used by one thread at a time
+    shareable = False
+
+    def __init__(self, info):
+        self.info = info
+        # a dry run (--run 0) neither binds nor needs the password,
+        # like SubprocessConn, which does not run any command
+        self.conn = None
+        if not info["run"]:
+            return
+        uri = info.get("ldap_uri") or get_default_ldap_uri()
+        passwd = resolve_ldap_passwd(info["ldap_passwd"])
+        if info["verbose"]:
+            print(f'bind: cn=admin,{info["ldap_domain"]} at {uri}', flush=True)
+        self.conn = ldap.initialize(uri)
+        self.conn.protocol_version = 3
+        self.conn.simple_bind_s(f'cn=admin,{info["ldap_domain"]}', passwd)
+
+    def call(self, what, method, *args):
+        """
+        call a method of the python-ldap connection and turn an exception
+        into a result code
+        """
+        if self.info["verbose"]:
+            print(f"{what}", flush=True)
+        if self.conn is None:
+            # dry run; searches find nothing, as with SubprocessConn
+            return LDAP_SUCCESS, []
+        if what != "result":
+            PROFILE.round_trip()
+        try:
+            return LDAP_SUCCESS, getattr(self.conn, method)(*args)
+        except ldap.LDAPError as exc:
+            err = exc.args[0] if exc.args and isinstance(exc.args[0], dict) else {}
+            return err.get("result", LDAP_OTHER), err
+
+    def report(self, err):
+        """
+        show what the server said
+        """
+        msg = " ".join(str(err.get(k, "")) for k in ("desc", "info")).strip()
+        if msg:
+            print(msg)
+
+    @profiled("search")
+    def search(self, base, filt="(objectClass=*)", attrs=(), scope="sub"):
+        """
+        search the subtree of base
+        """
+        scope_val = {"base" : ldap.SCOPE_BASE,
+                     "one" : ldap.SCOPE_ONELEVEL,
+                     "sub" : ldap.SCOPE_SUBTREE}[scope]
+        err, res = self.call(f"search: {base} {filt}", "search_s",
+                             base, scope_val, filt, list(attrs) or None)
+        if err:
+            return err, []
+        return 0, [(dn, decode_attrs(attrs_)) for dn, attrs_ in res if dn is not None]
+
+    @profiled("search")
+    def search_paged(self, base, filt="(objectClass=*)", attrs=(), page_size=500):
+        """
+        search the subtree of base with the paged results control
+        """
+        if self.conn is None:
+            if self.info["verbose"]:
+                print(f"search: {base} {filt} (page of {page_size})", flush=True)
+            return
+        ctrl = ldap.controls.SimplePagedResultsControl(True, size=page_size, cookie="")
+        while True:
+            err, msgid = self.call(f"search: {base} {filt} (page of {page_size})",
+                                   "search_ext", base, ldap.SCOPE_SUBTREE,
+                                   filt, list(attrs) or None, 0, [ctrl])
+            if err == 0:
+                err, result = self.call("result", "result3", msgid)
+            if err:
+                raise SearchError(err)
+            _, res, _, ctrls = result
+            for dn, attrs_ in res:
+                if dn is not None:
+                    yield dn, decode_attrs(attrs_)
+            cookies = [c.cookie for c in ctrls
+                       if c.controlType == ctrl.controlType]
+            if not cookies or not cookies[0]:
+                return
+            ctrl.cookie = cookies[0]
+
+    @profiled("search")
+    def exists(self, dn):
+        """
+        check if dn exists
+        """
+        return self.search(dn, attrs=("1.1",), scope="base")[0] == 0
+
+    def apply_record(self, rec):
+        """
+        apply a single LDIF record; return (result code, server response)
+        """
+        if rec["changetype"] == "add":
+            modlist = [(attr, [v.encode("utf-8") for v in vals])
+                       for attr, vals in rec["attrs"].items()]
+            err, res = self.call(f'add: {rec["dn"]}', "add_s",
+                                 rec["dn"], modlist)
+        elif rec["changetype"] == "modify":
+            ops = {"add" : ldap.MOD_ADD,
+                   "delete" : ldap.MOD_DELETE,
+                   "replace" : ldap.MOD_REPLACE}
+            modlist = [(ops[op], attr, [v.encode("utf-8") for v in vals] or None)
+                       for op, attr, vals in rec["mods"]]
+            err, res = self.call(f'modify: {rec["dn"]}', "modify_s",
+                                 rec["dn"], modlist)
+        elif rec["changetype"] == "delete":
+            err, res = self.call(f'delete: {rec["dn"]}', "delete_s",
+                                 rec["dn"])
+        else:
+            err, res = LDAP_OTHER, {"desc" : f'bad changetype: {rec["changetype"]}'}
+        return err, res
+
+    def apply(self, ldif):
+        """
+        apply all records in ldif
+        """
+        any_err = 0
+        for rec in parse_ldif(ldif):
+            if not self.info["run"]:
+                continue
+            err, res = self.apply_record(rec)
+            if err:
+                self.report(res)
+                any_err = any_err or err
+        return any_err
+
+    @profiled("batch")
+    def apply_many(self, ldifs):
+        """
+        apply many records, continuing after errors
+        """
+        failed = {}
+        for i, ldif in enumerate(ldifs):
+            for rec in parse_ldif(ldif):
+                if not self.info["run"]:
+                    continue
+                err, res = self.apply_record(rec)
+                if err:
+                    failed[i] = " ".join(str(res.get(k, "")) for k in ("desc", "info")).strip()
+                    break
+        return failed
+
+    @profiled("add")
+    def add(self, ldif):
+        """
+        add entries in ldif
+        """
+        return self.apply(ldif)
+
+    @profiled("modify")
+    def modify(self, ldif):
+        """
+        apply changes in ldif
+        """
+        return self.apply(ldif)
+
+    @profiled("delete")
+    def delete(self, dn):
+        """
+        delete dn
+        """
+        return self.apply(f"dn: {dn}\nchangetype: delete\n")
+
+    def close(self):
+        """
+        unbind
+        """
+        if self.conn is not None:
+            self.conn.unbind_s()
+
+def dn_key(dn):
+    """
+    normalize dn for comparison
+    """
+    return ",".join(rdn.strip().lower() for rdn in dn.split(","))
+
+def get_attr(attrs, attr):
+    """
+    values of attr (case-insensitive) in attrs
+    """
+    for key, vals in attrs.items():
+        if key.lower() == attr.lower():
+            return vals
+    return []
+
+def parse_filter(filt):
+    """
+    parse an LDAP search filter into a nested tuple
+    ("&"|"|", [sub, ...]), ("!", sub) or (op, attr, val)
+    """
+    def parse(pos):
+        assert filt[pos] == "(", (filt, pos)
+        pos += 1
+        if filt[pos] in "&|":
+            op = filt[pos]
+            pos += 1
+            subs = []
+            while filt[pos] == "(":
+                sub, pos = parse(pos)
+                subs.append(sub)
+            return (op, subs), pos + 1
+        if filt[pos] == "!":
+            sub, pos = parse(pos + 1)
+            return ("!", sub), pos + 1
+        end = filt.index(")", pos)
+        matched = re.match(r"(?P<attr>[^=<>~]+)(?P<op>=|>=|<=)(?P<val>.*)$",
+                           filt[pos:end])
+        return (matched.group("op"), matched.group("attr"),
+                matched.group("val")), end + 1
+    if not filt.startswith("("):
+        filt = f"({filt})"
+    return parse(0)[0]
+
+def match_filter(tree, attrs):
+    """
+    check if an entry with attrs matches a parsed filter
+    """
+    if tree[0] == "&":
+        return all(match_filter(sub, attrs) for sub in tree[1])
+    if tree[0] == "|":
+        return any(match_filter(sub, attrs) for sub in tree[1])
+    if tree[0] == "!":
+        return not match_filter(tree[1], attrs)
+    op, attr, val = tree
+    vals = get_attr(attrs, attr)
+    if op == "=" and val == "*":
+        return len(vals) > 0
+    if op == "=":
+        pat = re.compile("^" + ".*".join(re.escape(v) for v in val.split("*")) + "$",
+                         re.IGNORECASE)
+        return any(pat.match(v) for v in vals)
+    def cmp_key(v):
+        return (0, int(v), "") if v.lstrip("-").isdigit() else (1, 0, v)
+    if op == ">=":
+        return any(cmp_key(v) >= cmp_key(val) for v in vals)
+    return any(cmp_key(v) <= cmp_key(val) for v in vals)
+
+class MemoryConn:
+    """
+    an in-memory directory that behaves like slapd for what ldaptool does.
+    good for testing the tools without a server
+    """
+    # there is only one directory; threads share it
+    shareable = True
+
+    def __init__(self, info, ldif=None):
+        self.info = info
+        self.entries = {}       # dn_key -> (dn, attrs)
+        self.lock = threading.Lock()
+        # operational attributes, returned only when asked for by name
+        self.stamps = {}        # dn_key -> modifyTimestamp
+        self.changes = 0
+        self.csn = ""           # contextCSN of the suffix
+        if ldif is None:
+            dom = info["ldap_domain"]
+            ldif = (f"dn: {dom}\nobjectClass: dcObject\n\n"
+                    f"dn: ou=people,{dom}\nobjectClass: organizationalUnit\nou: people\n\n"
+                    f"dn: ou=groups,{dom}\nobjectClass: organizationalUnit\nou: groups\n")
+        for rec in parse_ldif(ldif):
+            self.entries[dn_key(rec["dn"])] = (rec["dn"], rec["attrs"])
+            self.touch(dn_key(rec["dn"]))
+
+    def touch(self, key=None):
+        """
+        update modifyTimestamp of key (if any) and contextCSN as slapd does
+        """
+        now = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+        self.changes += 1
+        if key is not None:
+            self.stamps[key] = f"{now}Z"
+        self.csn = f"{now}.{self.changes:06d}Z#000000#000#000000"
+
+    def operational(self, key):
+        """
+        operational attributes of key
+        """
+        ops = {"modifyTimestamp" : [self.stamps[key]]}
+        if key == dn_key(self.info["ldap_domain"]):
+            ops["contextCSN"] = [self.csn]
+        return ops
+
+    @profiled("search")
+    def search(self, base, filt="(objectClass=*)", attrs=(), scope="sub"):
+        """
+        search the subtree of base
+        """
+        base_key = dn_key(base)
+        if base_key not in self.entries:
+            return LDAP_NO_SUCH_OBJECT, []
+        tree = parse_filter(filt)
+        depth = base_key.count(",")
+        asked = " ".join([filt] + list(attrs)).lower()
+        with_ops = "modifytimestamp" in asked or "contextcsn" in asked
+        found = []
+        for key, (dn, ent_attrs) in self.entries.items():
+            if key != base_key and not key.endswith("," + base_key):
+                continue
+            level = key.count(",") - depth
+            if (scope == "base" and level != 0) or (scope == "one" and level != 1):
+                continue
+            all_attrs = dict(ent_attrs, **self.operational(key)) if with_ops else ent_attrs
+            if not match_filter(tree, all_attrs):
+                continue
+            if attrs and "1.1" in attrs:
+                found.append((dn, {}))
+            elif attrs:
+                found.append((dn, {a : list(get_attr(all_attrs, a))
+                                   for a in attrs if get_attr(all_attrs, a)}))
+            else:
+                found.append((dn, {a : list(v) for a, v in ent_attrs.items()}))
+        return LDAP_SUCCESS, found
+
+    @profiled("search")
+    def search_paged(self, base, filt="(objectClass=*)", attrs=(), page_size=500):
+        """
+        search the subtree of base (everything is already in memory)
+        """
+        err, found = self.search(base, filt, attrs)
+        if err:
+            raise SearchError(err)
+        yield from found
+
+    @profiled("search")
+    def exists(self, dn):
+        """
+        check if dn exists
+        """
+        return dn_key(dn) in self.entries
+
+    def apply_record(self, rec):
+        """
+        apply a single LDIF record
+        """
+        with self.lock:
+            return self.apply_record_locked(rec)
+
+    def apply_record_locked(self, rec):
+        """
+        apply a single LDIF record, with the lock held
+        """
+        key = dn_key(rec["dn"])
+        if rec["changetype"] == "add":
+            if key in self.entries:
+                return LDAP_ALREADY_EXISTS
+            if key.partition(",")[2] not in self.entries:
+                return LDAP_NO_SUCH_OBJECT
+            attrs = {a : list(v) for a, v in rec["attrs"].items()}
+            rdn_attr, _, rdn_val = rec["dn"].split(",")[0].partition("=")
+            if rdn_val.strip() not in get_attr(attrs, rdn_attr.strip()):
+                # slapd adds the value of the RDN too
+                attrs.setdefault(rdn_attr.strip(), []).append(rdn_val.strip())
+            self.entries[key] = (rec["dn"], attrs)
+            self.touch(key)
+            return LDAP_SUCCESS
+        if key not in self.entries:
+            return LDAP_NO_SUCH_OBJECT
+        if rec["changetype"] == "delete":
+            if any(k.endswith("," + key) for k in self.entries):
+                return LDAP_NOT_ALLOWED_ON_NONLEAF
+            del self.entries[key]
+            self.stamps.pop(key, None)
+            self.touch()
+            return LDAP_SUCCESS
+        dn, attrs = self.entries[key]
+        attrs = {a : list(v) for a, v in attrs.items()}
+        for op, attr, vals in rec["mods"]:
+            name = next((a for a in attrs if a.lower() == attr.lower()), attr)
+            cur = attrs.get(name, [])
+            if op == "add":
+                if any(v in cur for v in vals):
+                    return LDAP_TYPE_OR_VALUE_EXISTS
+                attrs[name] = cur + vals
+            elif op == "delete":
+                if not vals:
+                    if not cur:
+                        return LDAP_NO_SUCH_ATTRIBUTE
+                    attrs.pop(name, None)
+                    continue
+                if any(v not in cur for v in vals):
+                    return LDAP_NO_SUCH_ATTRIBUTE
+                attrs[name] = [v for v in cur if v not in vals]
+            else:
+                attrs[name] = list(vals)
+            if not attrs[name]:
+                del attrs[name]
+        self.entries[key] = (dn, attrs)
+        self.touch(key)
+        return LDAP_SUCCESS
+
+    def apply(self, ldif):
+        """
+        apply all records in ldif
+        """
+        any_err = 0
+        for rec in parse_ldif(ldif):
+            if self.info["verbose"]:
+                print(f'{rec["changetype"]}: {rec["dn"]}', flush=True)
+            if not self.info["run"]:
+                continue
+            err = self.apply_record(rec)
+            if err:
+                print(f'{rec["dn"]}: error {err}')
+            any_err = any_err or err
+        return any_err
+
+    @profiled("add")
+    def add(self, ldif):
+        """
+        add entries in ldif
+        """
+        return self.apply(ldif)
+
+    @profiled("modify")
+    def modify(self, ldif):
+        """
+        apply changes in ldif
+        """
+        return self.apply(ldif)
+
+    @profiled("delete")
+    def delete(self, dn):
+        """
+        delete dn
+        """
+        return self.apply(f"dn: {dn}\nchangetype: delete\n")
+
+    @profiled("batch")
+    def apply_many(self, ldifs):
+        """
+        apply many records, continuing after errors
+        """
+        failed = {}
+        for i, ldif in enumerate(ldifs):
+            for rec in parse_ldif(ldif):
+                if not self.info["run"]:
+                    continue
+                err = self.apply_record(rec)
+                if err:
+                    failed[i] = f"error {err}"
+                    break
+        return failed
+
+    def close(self):
+        """
+        nothing to do
+        """
+
+BACKENDS = ("auto", "ldap", "subprocess", "memory")
+
+def connect(info):
+    """
+    make a connection to the LDAP server with the backend info["backend"]
+    (auto: python3-ldap if available, subprocess otherwise)
+    """
+    backend = info.get("backend") or "auto"
+    if backend == "auto":
+        backend = "subprocess" if ldap is None else "ldap"
+    if backend == "ldap":
+        if ldap is None:
+            raise ImportError("backend 'ldap' needs python3-ldap")
+        return LdapConn(info)
+    if backend == "memory":
+        return MemoryConn(info)
+    return SubprocessConn(info)
+
+def get_conn(info):
+    """
+    the connection of info; make one if info has none yet
+    """
+    conn = info.get("conn")
+    if conn is None:
+        conn = connect(info)
+        info["conn"] = conn
+    return conn
+
+class ConnPool:
+    """
+    connections of worker threads: the connection of info if it can be
+    shared, or a session of each thread made on its first use
+    """
+    def __init__(self, info):
+        self.info = info
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.conns = []
+
+    def get(self):
+        """
+        the connection of the calling thread
+        """
+        conn = get_conn(self.info)
+        if conn.shareable:
+            return conn
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = connect(self.info)
+            with self.lock:
+                self.conns.append(self.local.conn)
+        return self.local.conn
+
+    def close(self):
+        """
+        close the sessions made for threads
+        """
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+
+#
+# a local copy of the DNs, id numbers and members of users and groups,
+# refreshed incrementally, to answer existence checks without searches
+#
+
+CACHE_ATTRS = ("uid", "cn", "uidNumber", "gidNumber", "memberUid", "modifyTimestamp")
+CACHE_BASES = ("ou=people", "ou=groups")
+
+def cache_attrs(attrs):
+    """
+    attrs of an entry with only CACHE_ATTRS (e.g., no userPassword)
+    """
+    names = {attr.lower() for attr in CACHE_ATTRS}
+    return {attr : list(vals) for attr, vals in attrs.items() if attr.lower() in names}
+
+class DirectoryCache:
+    """
+    entries under ou=people and ou=groups kept in a file.  on open,
+    nothing is searched if contextCSN of the suffix is unchanged;
+    otherwise entries modified since the last refresh (modifyTimestamp)
+    are read, with the DNs of all entries to notice deleted ones
+    """
+    def __init__(self, path, info):
+        self.path = path
+        self.domain = info["ldap_domain"]
+        self.uri = info.get("ldap_uri") or ""
+        self.lock = threading.Lock()
+        self.csn = ""
+        self.stamp = ""
+        self.entries = {}       # dn_key -> (dn, attrs)
+        with contextlib.suppress(FileNotFoundError, ValueError):
+            with open(path, encoding="utf-8") as cache_fp:
+                data = json.load(cache_fp)
+            if (data.get("domain"), data.get("uri")) == (self.domain, self.uri):
+                self.csn = data["csn"]
+                self.stamp = data["stamp"]
+                self.entries = {key : (dn, cache_attrs(attrs))
+                                for key, (dn, attrs) in data["entries"].items()}
+
+    def read_base(self, conn, base, filt="(objectClass=*)", attrs=CACHE_ATTRS):
+        """
+        entries right under base; an error raises SearchError
+        """
+        err, entries = conn.search(f"{base},{self.domain}", filt, attrs, scope="one")
+        if err == LDAP_NO_SUCH_OBJECT:
+            return []
+        if err:
+            raise SearchError(err)
+        return entries
+
+    def refresh(self, conn):
+        """
+        bring the entries up to date with the server
+        """
+        # contextCSN is there if the server keeps it (e.g., with syncprov)
+        err, top = conn.search(self.domain, attrs=("contextCSN",), scope="base")
+        csn = max((val for _, attrs in top for val in get_attr(attrs, "contextCSN")),
+                  default="") if not err else ""
+        if csn and csn == self.csn:
+            return
+        for base in CACHE_BASES:
+            suffix = dn_key(f"{base},{self.domain}")
+            old = {key for key in self.entries if key.endswith("," + suffix)}
+            if self.stamp and old:
+                changed = self.read_base(conn, base, f"(modifyTimestamp>={self.stamp})")
+                current = {dn_key(dn) for dn, _ in self.read_base(conn, base, attrs=("1.1",))}
+                known = old | {dn_key(dn) for dn, _ in changed}
+                if current - known:
+                    # entries added with an old timestamp (e.g., by slapadd)
+                    changed = self.read_base(conn, base)
+            else:
+                changed = self.read_base(conn, base)
+                current = {dn_key(dn) for dn, _ in changed}
+            for key in old - current:
+                del self.entries[key]
+            for dn, attrs in changed:
+                self.entries[dn_key(dn)] = (dn, attrs)
+        stamps = [get_attr(attrs, "modifyTimestamp") for _, attrs in self.entries.values()]
+        self.stamp = max((max(vals) for vals in stamps if vals), default="")
+        self.csn = csn
+
+    def save(self):
+        """
+        write the entries to the file atomically
+        """
+        data = {"domain" : self.domain, "uri" : self.uri,
+                "csn" : self.csn, "stamp" : self.stamp, "entries" : self.entries}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                  "w", encoding="utf-8") as cache_wp:
+            json.dump(data, cache_wp)
+        os.replace(tmp, self.path)
+
+    def has(self, dn):
+        """
+        check if dn is in the cache
+        """
+        return dn_key(dn) in self.entries
+
+    def values(self, dn, attr):
+        """
+        values of attr of dn in the cache
+        """
+        return get_attr(self.entries.get(dn_key(dn), ("", {}))[1], attr)
+
+    def added(self, dn, attrs=None):
+        """
+        dn was added (or found to exist); of attrs, only CACHE_ATTRS are kept
+        """
+        with self.lock:
+            self.entries.setdefault(dn_key(dn), (dn, cache_attrs(attrs or {})))
+
+    def value_added(self, dn, attr, val):
+        """
+        val was added to attr of dn
+        """
+        with self.lock:
+            _, attrs = self.entries.setdefault(dn_key(dn), (dn, {}))
+            name = next((a for a in attrs if a.lower() == attr.lower()), attr)
+            if val not in attrs.get(name, []):
+                attrs[name] = attrs.get(name, []) + [val]
+
+    def value_deleted(self, dn, attr, val):
+        """
+        val was deleted from attr of dn
+        """
+        with self.lock:
+            _, attrs = self.entries.get(dn_key(dn), (dn, {}))
+            for name in attrs:
+                if name.lower() == attr.lower() and val in attrs[name]:
+                    attrs[name] = [v for v in attrs[name] if v != val]
+
+    def deleted(self, dn):
+        """
+        dn was deleted (or found not to exist)
+        """
+        with self.lock:
+            self.entries.pop(dn_key(dn), None)
+
+    def under(self, base):
+        """
+        [(dn, attrs), ...] of entries right under base
+        """
+        suffix = dn_key(f"{base},{self.domain}")
+        return [ent for key, ent in self.entries.items() if key.endswith("," + suffix)]
+
+def open_dir_cache(info):
+    """
+    the DirectoryCache in the file info["dir_cache_file"] refreshed
+    from the server, or None if no file is given or it cannot be
+    refreshed (the tools then search the server as before)
+    """
+    path = info.get("dir_cache_file")
+    if not path or not info["run"]:
+        return None
+    cache = DirectoryCache(path, info)
+    try:
+        cache.refresh(get_conn(info))
+    except SearchError as exc:
+        print(f"{path}: not used, cannot read the directory (error {exc})")
+        return None
+    return cache
+
+def save_dir_cache(info):
+    """
+    save info["dir_cache"] if any
+    """
+    if info.get("dir_cache") is not None:
+        info["dir_cache"].save()
+
+#
+# directory operations
+#
+
 def get_next_val_for_attr(ldap_domain, ldap_passwd, attr, firstval, info):
     """
     find the next available value for attr
     """
-    dic = {"ldap_domain" : ldap_domain,
-           "ldap_passwd" : ldap_passwd,
-           "attr"     : attr,
-           "firstval" : firstval}
-    cmd = ("ldapsearch -x -w {ldap_passwd}"
-           " -D cn=admin,{ldap_domain}"
-           " -b ou=people,{ldap_domain}"
-           " -LLL {attr}".format(**dic))
-    attr_pat = re.compile(fr"{attr}: (?P<val>\d+)")
+    if info.get("dir_cache") is not None:
+        entries = info["dir_cache"].under("ou=people")
+    else:
+        _, entries = get_conn(info).search(f"ou=people,{ldap_domain}",
+                                           f"({attr}=*)", (attr,))
     vals = []
-    for line in run(cmd, info).stdout.strip().split("\n"):
-        matched = attr_pat.match(line)
-        if matched:
-            val = int(matched.group("val"))
-            vals.append(val)
+    for _, attrs in entries:
+        for val in get_attr(attrs, attr):
+            if val.isdigit():
+                vals.append(int(val))
     next_val = firstval
-    for val in sorted(vals):
+    for val in sorted(set(vals)):
         if val < firstval:
             continue
         if val > next_val:
@@ -83,138 +1349,955 @@ def get_next_gid(ldap_domain, ldap_passwd, firstgid, info):
     """
     return get_next_val_for_attr(ldap_domain, ldap_passwd, "gidNumber", firstgid, info)
 
+class IdAllocator:
+    """
+    hand out free uidNumber/gidNumber values.
+    used values are kept as sorted, disjoint intervals [starts[i], ends[i]]
+    so that finding the next free value is a binary search
+    """
+    def __init__(self, firstval):
+        self.firstval = firstval
+        self.starts = []
+        self.ends = []
+        self.owners = {}        # val -> name of the user/group using it
+
+    def is_used(self, val):
+        """
+        check if val is used
+        """
+        i = bisect.bisect_right(self.starts, val) - 1
+        return i >= 0 and self.ends[i] >= val
+
+    def reserve(self, val, owner=None):
+        """
+        mark val as used by owner.
+        return the other owner if val is already used by someone else
+        """
+        val = int(val)
+        prev = self.owners.get(val)
+        if prev is not None and owner is not None and prev != owner:
+            return prev
+        if owner is not None:
+            self.owners[val] = owner
+        if self.is_used(val):
+            return None
+        i = bisect.bisect_right(self.starts, val)
+        join_left = i > 0 and self.ends[i - 1] == val - 1
+        join_right = i < len(self.starts) and self.starts[i] == val + 1
+        if join_left and join_right:
+            self.ends[i - 1] = self.ends[i]
+            del self.starts[i]
+            del self.ends[i]
+        elif join_left:
+            self.ends[i - 1] = val
+        elif join_right:
+            self.starts[i] = val
+        else:
+            self.starts.insert(i, val)
+            self.ends.insert(i, val)
+        return None
+
+    def next_free(self):
+        """
+        the smallest unused value >= firstval
+        """
+        i = bisect.bisect_right(self.starts, self.firstval) - 1
+        if i >= 0 and self.ends[i] >= self.firstval:
+            return self.ends[i] + 1
+        return self.firstval
+
+    def allocate(self, owner=None):
+        """
+        take the smallest unused value >= firstval
+        """
+        val = self.next_free()
+        self.reserve(val, owner)
+        return val
+
+def id_allocator_of(entries, attr, owner_attr, firstval):
+    """
+    make an IdAllocator knowing all values of attr in entries
+    """
+    alloc = IdAllocator(int(firstval))
+    for _, attrs in entries:
+        owner = (get_attr(attrs, owner_attr) or [None])[0]
+        for val in get_attr(attrs, attr):
+            if val.isdigit():
+                alloc.reserve(int(val), owner)
+    return alloc
+
+def make_id_allocator(info, attr, base, owner_attr, firstval):
+    """
+    make an IdAllocator knowing all values of attr under base
+    (one search for the whole run)
+    """
+    if info.get("dir_cache") is not None:
+        entries = info["dir_cache"].under(base)
+    else:
+        _, entries = get_conn(info).search(f'{base},{info["ldap_domain"]}',
+                                           f"({attr}=*)", (attr, owner_attr))
+    return id_allocator_of(entries, attr, owner_attr, firstval)
+
+def make_uid_allocator(info):
+    """
+    IdAllocator for uidNumber of users
+    """
+    return make_id_allocator(info, "uidNumber", "ou=people", "uid", info["firstuid"])
+
+def make_gid_allocator(info):
+    """
+    IdAllocator for gidNumber of groups
+    """
+    return make_id_allocator(info, "gidNumber", "ou=groups", "cn", info["firstgid"])
+
+def reserve_explicit_ids(rows, alloc, id_key, owner_key):
+    """
+    reserve ids given explicitly in csv rows [(origin, row), ...]
+    before any other id is allocated.
+    return {origin : message} for ids already used by another owner
+    """
+    collisions = {}
+    for origin, row in rows:
+        val = row.get(id_key) or ""
+        if not val.strip().isdigit():
+            continue
+        other = alloc.reserve(int(val), row[owner_key])
+        if other is not None:
+            collisions[origin] = (f"{id_key} {val} of {row[owner_key]}"
+                                  f" is already used by {other}")
+    return collisions
+
+#
+# reading csv files a chunk at a time, remembering how far we got
+#
+
+def read_csv_rows(files):
+    """
+    generate ((file, index), row) of csv files, one row at a time
+    """
+    for csv_file in files:
+        with open(csv_file, encoding="utf-8") as csv_fp:
+            for i, row in enumerate(csv.DictReader(csv_fp)):
+                yield (csv_file, i), row
+
+def chunks(items, size):
+    """
+    generate lists of up to size items
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def process_in_chunks(info, process_chunk):
+    """
+    call process_chunk([(origin, row), ...]) -> ({origin : error}, [origin done, ...])
+    for rows of the csv files info["file"], info["batch_size"] rows at a time,
+    saving the checkpoint info["checkpoint"] after each chunk.  in each
+    file, only rows before the first one failed or not done are
+    committed (rows may be done out of order, see run_rows), so that
+    --resume retries from there.
+    with info["exit_on_error"], stop after the first chunk having errors
+    """
+    ckpt = Checkpoint(info.get("checkpoint"), info["file"], info.get("resume"))
+    any_err = 0
+    held = set()                # files with a row failed or not done
+    for chunk in chunks(ckpt.pending(read_csv_rows(info["file"])),
+                        max(1, int(info.get("batch_size") or 1))):
+        errors, done = process_chunk(chunk)
+        any_err = any_err or (1 if errors else 0)
+        stop = errors and info["exit_on_error"]
+        done = set(done)
+        for origin, _ in chunk:
+            if origin not in done or origin in errors:
+                held.add(origin[0])
+            if origin[0] not in held:
+                ckpt.commit(origin)
+        ckpt.save()
+        if stop:
+            break
+    return any_err
+
+def key_lanes(rows, keys_of):
+    """
+    split rows [(origin, row), ...] into lanes so that rows sharing a
+    key (e.g., the dn of a user or of its primary group) are in the
+    same lane, in the order of rows
+    """
+    parent = {}
+    def find(key):
+        while parent.setdefault(key, key) != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+    for _, row in rows:
+        keys = [find(key) for key in keys_of(row)]
+        for key in keys[1:]:
+            parent[key] = keys[0]
+    lanes = {}
+    for origin, row in rows:
+        lanes.setdefault(find(keys_of(row)[0]), []).append((origin, row))
+    return list(lanes.values())
+
+def run_rows(rows, func, keys_of, info):
+    """
+    call func(row) -> error code for rows [(origin, row), ...] with up
+    to info["workers"] LDAP sessions at a time.  rows sharing a key
+    (see key_lanes) run one after another in their order; other rows
+    run concurrently.  with info["exit_on_error"] no row is started
+    after an error.  returns ({origin : error code}, [origin done, ...])
+    with origins done in the order of rows; with more than one lane a
+    row after one not started may be done
+    """
+    workers = max(1, int(info.get("workers") or 1))
+    if workers == 1 or len(rows) < 2:
+        lanes = [rows]
+    else:
+        lanes = key_lanes(rows, keys_of)
+    pool = ConnPool(info)
+    stop = threading.Event()
+    results = {}
+    def run_lane(lane):
+        for origin, row in lane:
+            if stop.is_set():
+                return
+            row["conn"] = pool.get() if len(lanes) > 1 else get_conn(info)
+            err = func(row)
+            results[origin] = err
+            if err and info["exit_on_error"]:
+                stop.set()
+    try:
+        if len(lanes) == 1:
+            run_lane(lanes[0])
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [executor.submit(run_lane, lane) for lane in lanes]:
+                    future.result()
+    finally:
+        pool.close()
+    errors = {origin : err for origin, err in results.items() if err}
+    return errors, [origin for origin, _ in rows if origin in results]
+
+def print_errors(errors, files, with_message=True):
+    """
+    print errors {(file, index) : message} as file:line
+    """
+    for csv_file, i in sorted(errors, key=lambda o: (files.index(o[0]), o[1])):
+        if with_message:
+            print(f"{csv_file}:{i + 1}: {errors[csv_file, i]}")
+        print(f"{csv_file}:{i + 1}: error occurred")
+
+@contextlib.contextmanager
+def timed(times, phase):
+    """
+    add the time spent in the with block to times[phase]
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        times[phase] = times.get(phase, 0.0) + time.monotonic() - start
+
+def format_times(times):
+    """
+    "phase1 0.12s, phase2 3.40s, ..." of times {phase : seconds}
+    """
+    return ", ".join(f"{phase} {sec:.2f}s" for phase, sec in times.items())
+
+def row_bytes(row):
+    """
+    bytes of a csv row for checkpoint digests
+    """
+    return json.dumps(list(row.values()), ensure_ascii=False).encode("utf-8")
+
+class Checkpoint:
+    """
+    the last row committed in each input file and a sha256 of the rows
+    up to it, saved in a json file so that a later run with --resume
+    continues after it.  rows are skipped only if they are unchanged
+    (rows after the last committed one may have been edited)
+    """
+    def __init__(self, path, files, resume):
+        self.path = path
+        self.state = {}         # file -> [index of last committed row, sha256]
+        self.pending_bytes = {}
+        if path is None:
+            return
+        saved = {}
+        if resume and os.path.exists(path):
+            with open(path, encoding="utf-8") as ckpt_fp:
+                saved = json.load(ckpt_fp).get("files", {})
+        for csv_file in files:
+            done, digest = -1, hashlib.sha256()
+            want = saved.get(csv_file, {"done" : -1})
+            if want["done"] >= 0:
+                for (_, i), row in read_csv_rows([csv_file]):
+                    if i > want["done"]:
+                        break
+                    digest.update(row_bytes(row))
+                    done = i
+                if done == want["done"] and digest.hexdigest() == want["sha256"]:
+                    print(f"{csv_file}: resuming after line {done + 1}")
+                else:
+                    print(f"{csv_file}: rows done in the last run have changed;"
+                          " starting from the beginning")
+                    done, digest = -1, hashlib.sha256()
+            self.state[csv_file] = [done, digest]
+
+    def pending(self, rows):
+        """
+        rows [(origin, row), ...] not committed yet
+        """
+        for origin, row in rows:
+            if self.path is None:
+                yield origin, row
+            elif origin[1] > self.state[origin[0]][0]:
+                self.pending_bytes[origin] = row_bytes(row)
+                yield origin, row
+
+    def commit(self, origin):
+        """
+        record that the row at origin (and all rows before it) is done
+        """
+        if self.path is None:
+            return
+        state = self.state[origin[0]]
+        if origin[1] > state[0]:
+            state[0] = origin[1]
+            state[1].update(self.pending_bytes.pop(origin))
+
+    def save(self):
+        """
+        write the checkpoint file (atomically)
+        """
+        if self.path is None:
+            return
+        self.pending_bytes.clear()
+        files = {csv_file : {"done" : done, "sha256" : digest.hexdigest()}
+                 for csv_file, (done, digest) in self.state.items()}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as ckpt_fp:
+            json.dump({"files" : files}, ckpt_fp, indent=1)
+        os.replace(tmp, self.path)
+
 def search_for_key(ldap_domain, ldap_passwd, key, info):
     """
     search the domain for key
     """
-    dic = {"ldap_domain" : ldap_domain,
-           "ldap_passwd" : ldap_passwd,
-           "key" : key}
-    search_cmd = ("ldapsearch -x -w {ldap_passwd}"
-                  " -D cn=admin,{ldap_domain} -b {key}"
-                  .format(**dic))
-    comp = run(search_cmd, info, capture_output=False)
-    return comp.returncode
+    err, entries = get_conn(info).search(key)
+    if entries:
+        print(format_ldif(entries), end="", flush=True)
+    return err
 
 def add_ldif_if_not_exist(ldap_domain, ldap_passwd, key, gen_ldif, info):
     """
     add user to LDAP if it does not exist
     """
-    dic = {"ldap_domain" : ldap_domain,
-           "ldap_passwd" : ldap_passwd,
-           "key" : key}
-    search_cmd = ("ldapsearch -x -w {ldap_passwd}"
-                  " -D cn=admin,{ldap_domain} -b {key}"
-                  .format(**dic))
-    add_cmd = ("ldapadd -x -w {ldap_passwd}"
-               " -D cn=admin,{ldap_domain}"
-               .format(**dic))
-    if run(search_cmd, info).returncode == 0:
+    conn = get_conn(info)
+    cache = info.get("dir_cache")
+    if cache is None:
+        exists = conn.exists(key)
+    else:
+        exists = cache.has(key)
+    if exists:
+        print(f"{key} already exists")
+        return 0                # OK
+    ldif = gen_ldif()
+    err = conn.add(ldif)
+    if err == LDAP_ALREADY_EXISTS and cache is not None:
+        # added since the cache was refreshed
+        cache.added(key)
         print(f"{key} already exists")
         return 0                # OK
-    comp = run(add_cmd, info, check=True, input=gen_ldif())
-    if comp.returncode == 0:
+    if err == 0:
+        if cache is not None:
+            cache.added(key, parse_ldif(ldif)[0]["attrs"])
         print(f"added {key}")
     else:
         print(f"error during adding {key}")
-    return comp.returncode
+    return err
 
 def add_attr_val_ldif(ldap_domain, ldap_passwd, key, filt, gen_ldif, info):
     """
     add user to LDAP if it does not exist
     """
-    dic = {"ldap_domain" : ldap_domain,
-           "ldap_passwd" : ldap_passwd,
-           "key" : key,
-           "filter" : filt}
-    search_cmd = ("ldapsearch -x -w {ldap_passwd}"
-                  " -D cn=admin,{ldap_domain} -b {key} '{filter}'"
-                  .format(**dic))
-    mod_cmd = ("ldapmodify -x -w {ldap_passwd}"
-               " -D cn=admin,{ldap_domain}"
-               .format(**dic))
-    comp = run(search_cmd, info)
-    if comp.returncode != 0:
-        print(f"{key} does not exist")
-        return comp.returncode
-    if "numEntries:" in comp.stdout:
-        print("{key} exists and already has {filter}".format(**dic))
+    conn = get_conn(info)
+    cache = info.get("dir_cache")
+    attr, _, val = filt.strip("()").partition("=")
+    if cache is not None and cache.has(key):
+        has_val = val in cache.values(key, attr)
+    else:
+        # not in the cache: the server tells whether key exists
+        err, entries = conn.search(key, filt, ("1.1",), scope="base")
+        if err != 0:
+            print(f"{key} does not exist")
+            return err
+        has_val = bool(entries)
+    if has_val:
+        print(f"{key} exists and already has {filt}")
         return 0
-    comp = run(mod_cmd, info, check=True, input=gen_ldif())
-    if comp.returncode == 0:
+    err = conn.modify(gen_ldif())
+    if err == LDAP_TYPE_OR_VALUE_EXISTS and cache is not None:
+        # added since the cache was refreshed
+        cache.value_added(key, attr, val)
+        print(f"{key} exists and already has {filt}")
+        return 0
+    if err == 0:
+        if cache is not None:
+            cache.value_added(key, attr, val)
         print(f"modified {key}")
     else:
         print(f"error during modifying {key}")
-    return comp.returncode
+    return err
 
 def del_key_if_exist(ldap_domain, ldap_passwd, key, info):
     """
     add user to LDAP if it does not exist
     """
-    dic = {"ldap_domain" : ldap_domain,
-           "ldap_passwd" : ldap_passwd,
-           "key" : key}
-    search_cmd = ("ldapsearch -x -w {ldap_passwd}"
-                  " -D cn=admin,{ldap_domain} -b {key}"
-                  .format(**dic))
-    del_cmd = ("ldapdelete -x -w {ldap_passwd}"
-               " -D cn=admin,{ldap_domain} {key}"
-               .format(**dic))
-    if run(search_cmd, info).returncode != 0:
+    conn = get_conn(info)
+    cache = info.get("dir_cache")
+    if cache is None:
+        exists = conn.exists(key)
+    else:
+        exists = cache.has(key)
+    if not exists:
         print(f"{key} does not exist")
         return 0                # OK
-    comp = run(del_cmd, info, check=True)
-    if comp.returncode == 0:
+    err = conn.delete(key)
+    if err == LDAP_NO_SUCH_OBJECT and cache is not None:
+        # deleted since the cache was refreshed
+        err = 0
+        print(f"{key} does not exist")
+    elif err == 0:
         print(f"deleted {key}")
     else:
         print(f"error during deleting {key}")
-    return comp.returncode
+    if err == 0 and cache is not None:
+        cache.deleted(key)
+    return err
+
+#
+# listing users and groups.  besides LDIF, rows can be written in the
+# column layout of ldap_users.csv/ldap_groups.csv (as CSV or JSON Lines)
+# so that the output can be fed back to ldap_addusers/ldap_sync
+#
+
+LIST_FORMATS = ("ldif", "csv", "jsonl")
+
+# (csv column, LDAP attribute); None for a column that is not
+# an attribute of the entry itself
+USER_COLUMNS = (("user", "uid"), ("grp", None), ("cn", "cn"), ("sn", "sn"),
+                ("shell", "loginShell"), ("uid", "uidNumber"), ("gid", "gidNumber"),
+                ("home", "homeDirectory"), ("home_perm", None),
+                ("authorized_keys", None), ("groups", None),
+                ("password_hash", "userPassword"), ("password", None))
+GROUP_COLUMNS = (("grp", "cn"), ("cn", "cn"), ("gid", "gidNumber"))
+
+def select_columns(columns, attrs):
+    """
+    columns to output for the attributes requested with --attrs.
+    a column not backed by an attribute (grp, groups, home_perm, ...)
+    is selected by its column name.  all columns if attrs is empty
+    """
+    if not attrs:
+        return list(columns)
+    return [(col, attr) for col, attr in columns
+            if (attr if attr else col) in attrs]
+
+def parse_attrs_opt(attrs):
+    """
+    "uid,uidNumber" -> ["uid", "uidNumber"]
+    """
+    return [a.strip() for a in (attrs or "").split(",") if a.strip()]
+
+class RowWriter:
+    """
+    write rows (dicts) as CSV with a header or as JSON Lines
+    """
+    def __init__(self, fmt, fields, out):
+        self.fmt = fmt
+        self.out = out
+        self.fields = fields
+        if fmt == "csv":
+            self.writer = csv.DictWriter(out, fieldnames=fields, lineterminator="\n")
+            self.writer.writeheader()
+
+    def write(self, row):
+        """
+        write a row
+        """
+        if self.fmt == "csv":
+            self.writer.writerow(row)
+        else:
+            self.out.write(json.dumps({f : row[f] for f in self.fields}) + "\n")
+
+def entry_row(attrs, columns):
+    """
+    row of a search result for columns; multiple values are joined with ","
+    """
+    return {col : ",".join(get_attr(attrs, attr)) if attr else ""
+            for col, attr in columns}
+
+def search_listing(info, base, filt, attrs):
+    """
+    page through the entries under base.
+    a missing base is an empty listing
+    """
+    page_size = info.get("page_size") or 500
+    try:
+        yield from get_conn(info).search_paged(base, filt, attrs, page_size)
+    except SearchError as exc:
+        if exc.args[0] != LDAP_NO_SUCH_OBJECT:
+            raise
+
+def print_listing(info, base, filt, columns, fill_row=None, extra_attrs=()):
+    """
+    print entries under base matching filt in info["format"].
+    fill_row(row, attrs) fills columns not taken from the entry
+    """
+    fmt = info.get("format") or "ldif"
+    requested = parse_attrs_opt(info.get("attrs"))
+    out = sys.stdout
+    try:
+        if fmt == "ldif":
+            for dn, attrs in search_listing(info, base, filt, requested):
+                out.write(format_ldif([(dn, attrs)]) + "\n")
+            return 0
+        columns = select_columns(columns, requested)
+        attrs = sorted({attr for _, attr in columns if attr} | set(extra_attrs))
+        writer = RowWriter(fmt, [col for col, _ in columns], out)
+        for _, ent_attrs in search_listing(info, base, filt, attrs or ["1.1"]):
+            row = entry_row(ent_attrs, columns)
+            if fill_row:
+                fill_row(row, ent_attrs)
+            writer.write(row)
+        return 0
+    except SearchError as exc:
+        return exc.args[0]
+    finally:
+        out.flush()
+
+def home_columns(row, home):
+    """
+    fill home_perm and authorized_keys from the home directory,
+    when it is on this host
+    """
+    try:
+        if "home_perm" in row:
+            row["home_perm"] = f"{os.stat(home).st_mode & 0o7777:04o}"
+        if "authorized_keys" in row:
+            with open(f"{home}/.ssh/authorized_keys", encoding="utf-8") as auth_key_fp:
+                row["authorized_keys"] = auth_key_fp.read()
+    except OSError:
+        pass
 
 def list_users(info):
     """
     list of all users
     """
     key = f'ou=people,{info["ldap_domain"]}' # .format(**info)
-    return search_for_key(info["ldap_domain"], info["ldap_passwd"], key, info)
+    if (info.get("format") or "ldif") == "ldif":
+        return print_listing(info, key, "(objectClass=*)", USER_COLUMNS)
+    names = {col for col, _ in select_columns(USER_COLUMNS, parse_attrs_opt(info.get("attrs")))}
+    # the primary group name and the groups of a user come from ou=groups
+    gid_names = {}
+    user_groups = {}
+    if names & {"grp", "groups"}:
+        try:
+            for _, attrs in search_listing(info, f'ou=groups,{info["ldap_domain"]}',
+                                           "(objectClass=posixGroup)",
+                                           ["cn", "gidNumber", "memberUid"]):
+                grp = get_attr(attrs, "cn")[0]
+                for gid in get_attr(attrs, "gidNumber"):
+                    gid_names.setdefault(gid, grp)
+                for user in get_attr(attrs, "memberUid"):
+                    user_groups.setdefault(user, []).append(grp)
+        except SearchError as exc:
+            return exc.args[0]
+    def fill_row(row, attrs):
+        users = get_attr(attrs, "uid")
+        gids = get_attr(attrs, "gidNumber")
+        homes = get_attr(attrs, "homeDirectory")
+        if "grp" in row:
+            row["grp"] = gid_names.get(gids[0], "") if gids else ""
+        if "groups" in row:
+            row["groups"] = " ".join(user_groups.get(users[0], []) if users else [])
+        if homes and names & {"home_perm", "authorized_keys"}:
+            home_columns(row, homes[0])
+    return print_listing(info, key, "(objectClass=posixAccount)", USER_COLUMNS,
+                         fill_row, ["uid", "gidNumber", "homeDirectory"])
 
 def list_groups(info):
     """
     list of all groups
     """
     key = f'ou=groups,{info["ldap_domain"]}' # .format(**info)
-    return search_for_key(info["ldap_domain"], info["ldap_passwd"], key, info)
+    return print_listing(info, key, "(objectClass=posixGroup)", GROUP_COLUMNS)
 
-def addgroup(info):
+def read_directory(info, people=True):
     """
-    add a group to LDAP if it does not exist
+    read the DNs of all users (if people) and groups and
+    the members of all groups with one search each
     """
-    key = f'cn={info["grp"]},ou=groups,{info["ldap_domain"]}' # .format(**info)
-    def gen_ldif():
-        ldif = f'''dn: cn={info["grp"]},ou=groups,{info["ldap_domain"]}
+    cache = info.get("dir_cache")
+    if cache is not None:
+        return snap_of_cache(cache, people)
+    conn = get_conn(info)
+    snap = {"dns" : set(), "members" : {}}
+    if people:
+        _, entries = conn.search(f'ou=people,{info["ldap_domain"]}', attrs=("1.1",))
+        for dn, _ in entries:
+            snap["dns"].add(dn_key(dn))
+    _, groups = conn.search(f'ou=groups,{info["ldap_domain"]}', attrs=("memberUid",))
+    for dn, attrs in groups:
+        snap["dns"].add(dn_key(dn))
+        snap["members"][dn_key(dn)] = set(get_attr(attrs, "memberUid"))
+    return snap
+
+def snap_of_cache(cache, people=True):
+    """
+    the snapshot read_directory makes, from a DirectoryCache
+    """
+    snap = {"dns" : set(), "members" : {}}
+    if people:
+        snap["dns"].update(dn_key(dn) for dn, _ in cache.under("ou=people"))
+    for dn, attrs in cache.under("ou=groups"):
+        snap["dns"].add(dn_key(dn))
+        snap["members"][dn_key(dn)] = set(get_attr(attrs, "memberUid"))
+    return snap
+
+def apply_batches(records, info):
+    """
+    send records [(key, ldif, origin), ...] to the server
+    info["batch_size"] records at a time.
+    return ({index : error message} of failed records,
+            number of records sent)
+    """
+    conn = get_conn(info)
+    batch_size = max(1, int(info.get("batch_size") or 1))
+    failed = {}
+    sent = 0
+    while sent < len(records):
+        batch = records[sent:sent + batch_size]
+        errors = conn.apply_many([ldif for _, ldif, _ in batch])
+        for i, (key, _, _) in enumerate(batch):
+            if i in errors:
+                print(f"error during applying {key}: {errors[i]}")
+                failed[sent + i] = errors[i]
+        sent += len(batch)
+        if failed and info.get("exit_on_error"):
+            break
+    return failed, sent
+
+def add_entries_batch(entries, snap, info):
+    """
+    add entries [(key, ldif, origin), ...] that are not in the
+    directory snapshot snap (made by read_directory) in batches.
+    return {origin : error message} of failed entries
+    """
+    records = []
+    for key, ldif, origin in entries:
+        if dn_key(key) in snap["dns"]:
+            print(f"{key} already exists")
+            continue
+        snap["dns"].add(dn_key(key))
+        records.append((key, ldif, origin))
+    failed, sent = apply_batches(records, info)
+    cache = info.get("dir_cache")
+    errors = {}
+    for i, (key, ldif, origin) in enumerate(records):
+        if i in failed:
+            errors.setdefault(origin, failed[i])
+        if i in failed or i >= sent:
+            snap["dns"].discard(dn_key(key))
+        else:
+            if cache is not None:
+                cache.added(key, parse_ldif(ldif)[0]["attrs"])
+            print(f"added {key}")
+    return errors
+
+def apply_member_changes(changes, info):
+    """
+    apply changes {group : (ldif, [origin, ...])}, one record per group.
+    return ({origin : error message} of failed changes, [group modified, ...])
+    """
+    records = [(key, ldif, origins) for key, (ldif, origins) in changes.items()]
+    failed, sent = apply_batches(records, info)
+    errors = {}
+    modified = []
+    for i, (key, _, origins) in enumerate(records[:sent]):
+        if i in failed:
+            for origin in origins:
+                errors.setdefault(origin, failed[i])
+        else:
+            modified.append(key)
+            print(f"modified {key}")
+    return errors, modified
+
+def add_memberships(memberships, snap, info):
+    """
+    add memberships [(group, user, origin), ...] that are not in the
+    directory snapshot snap (made by read_directory), modifying each
+    group once with all of its new members.
+    return {origin : error message} of failed memberships
+    """
+    errors = {}
+    new_members = {}            # key -> (group, [user, ...], [origin, ...])
+    for extra_group, user, origin in memberships:
+        key = f'cn={extra_group},ou=groups,{info["ldap_domain"]}'
+        if dn_key(key) not in snap["dns"]:
+            print(f"{key} does not exist")
+            errors.setdefault(origin, f"{key} does not exist")
+            continue
+        members = snap["members"].setdefault(dn_key(key), set())
+        if user in members:
+            print(f"{key} exists and already has (memberUid={user})")
+            continue
+        members.add(user)
+        _, users, origins = new_members.setdefault(key, (extra_group, [], []))
+        users.append(user)
+        origins.append(origin)
+    changes = {key : (member_ldif(extra_group, users, info), origins)
+               for key, (extra_group, users, origins) in new_members.items()}
+    member_errors, modified = apply_member_changes(changes, info)
+    errors.update(member_errors)
+    cache = info.get("dir_cache")
+    if cache is not None:
+        for key in modified:
+            for user in new_members[key][1]:
+                cache.value_added(key, "memberUid", user)
+    return errors
+
+def member_removals(users, snap):
+    """
+    {group key : [user, ...]} removing users [(user, origin), ...] from
+    all groups they are members of in the directory snapshot snap
+    (which is updated accordingly)
+    """
+    names = {user for user, _ in users}
+    old_members = {}            # key -> [user, ...]
+    for key, members in snap["members"].items():
+        gone = sorted(members & names)
+        if gone:
+            old_members[key] = gone
+            members.difference_update(gone)
+    return old_members
+
+def del_memberships(users, snap, info):
+    """
+    remove users [(user, origin), ...] from all groups they are members of
+    in the directory snapshot snap, modifying each group once.
+    return {origin : error message} of failed removals
+    """
+    origin_of = dict(users)
+    changes = {}
+    removals = member_removals(users, snap)
+    for key, gone in removals.items():
+        lines = [f"dn: {key}", "changetype: modify", "delete: memberUid"]
+        lines += [f"memberUid: {user}" for user in gone]
+        changes[key] = ("\n".join(lines) + "\n", [origin_of[user] for user in gone])
+    errors, modified = apply_member_changes(changes, info)
+    cache = info.get("dir_cache")
+    if cache is not None:
+        for key in modified:
+            for user in removals[key]:
+                cache.value_deleted(key, "memberUid", user)
+    return errors
+
+def del_entries_batch(entries, snap, info):
+    """
+    delete entries [(key, origin), ...] that are in the directory
+    snapshot snap in batches (changetype: delete records sent with
+    ldapadd -c).  return ({origin : error message} of failed entries,
+    [origin, ...] of entries deleted)
+    """
+    records = []
+    for key, origin in entries:
+        if dn_key(key) not in snap["dns"]:
+            print(f"{key} does not exist")
+            continue
+        records.append((key, f"dn: {key}\nchangetype: delete\n", origin))
+    failed, sent = apply_batches(records, info)
+    cache = info.get("dir_cache")
+    errors = {}
+    deleted = []
+    for i, (key, _, origin) in enumerate(records[:sent]):
+        if i in failed:
+            errors.setdefault(origin, failed[i])
+        else:
+            snap["dns"].discard(dn_key(key))
+            if cache is not None:
+                cache.deleted(key)
+            deleted.append(origin)
+            print(f"deleted {key}")
+    return errors, deleted
+
+#
+# home directories of deleted users
+#
+
+HOME_ACTIONS = ("keep", "archive", "remove")
+
+def read_homes(info):
+    """
+    {user : (homeDirectory, uidNumber)} of all users (one search)
+    """
+    _, people = get_conn(info).search(f'ou=people,{info["ldap_domain"]}',
+                                      "(objectClass=posixAccount)",
+                                      ("uid", "uidNumber", "homeDirectory"))
+    homes = {}
+    for _, attrs in people:
+        user = get_attr(attrs, "uid")
+        home = get_attr(attrs, "homeDirectory")
+        uid_num = get_attr(attrs, "uidNumber")
+        if user and home and uid_num and uid_num[0].isdigit():
+            homes[user[0]] = (home[0], int(uid_num[0]))
+    return homes
+
+def home_archive(user, info):
+    """
+    the file the home of user is archived to
+    """
+    return os.path.join(info["archive_dir"], f"{user}.tar.gz")
+
+def describe_home_removal(user, home, info):
+    """
+    what remove_home does to home
+    """
+    if info["home_action"] == "archive":
+        return f"archive {home} to {home_archive(user, info)} and remove it"
+    return f"remove {home}"
+
+@profiled("rmdir")
+def remove_home(user, home, uid_num, info):
+    """
+    archive (with info["home_action"] == "archive") and remove home
+    of user.  a home that is not a directory owned by uid_num (e.g.,
+    shared or already reused) is left alone with an OSError
+    """
+    if not os.path.isabs(home) or os.path.normpath(home) == "/":
+        raise OSError(f"{home} is not an absolute path to remove")
+    try:
+        st = os.lstat(home)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != uid_num:
+        raise OSError(f"{home} is not a directory owned by {uid_num}, left alone")
+    if info["home_action"] == "archive":
+        archive = home_archive(user, info)
+        os.makedirs(info["archive_dir"], exist_ok=True, mode=0o700)
+        # tarfile rather than shutil.make_archive, which may chdir
+        tmp = f"{archive}.tmp"
+        with tarfile.open(tmp, "w:gz") as tar:
+            tar.add(home, arcname=os.path.basename(os.path.normpath(home)))
+        os.replace(tmp, archive)
+    shutil.rmtree(home)
+
+def remove_homes(users, homes, info):
+    """
+    archive and/or remove (info["home_action"]) homes of users
+    [(user, origin), ...] found in homes {user : (home, uid)} with a
+    pool of info["home_workers"] threads.  returns {origin : error message}
+    """
+    if info.get("home_action", "keep") == "keep":
+        return {}
+    todo = [(user, origin) for user, origin in users if user in homes]
+    def remove(user):
+        try:
+            remove_home(user, *homes[user], info)
+            print(f"{describe_home_removal(user, homes[user][0], info)}: done")
+            return None
+        except OSError as exc:
+            return f"home: {exc}"
+    errors = {}
+    workers = max(1, int(info.get("home_workers") or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for (_, origin), err in zip(todo, pool.map(remove, [user for user, _ in todo])):
+            if err:
+                errors[origin] = err
+    return errors
+
+def set_if_empty(dic, key, defulat_val):
+    """
+    if dic has no key or the value for the key is "",
+    set the value to default_val
+    """
+    if dic.get(key, "") == "":
+        dic[key] = defulat_val
+
+def user_info_set_defaults(info):
+    """
+    set default values for a row of ldap_users.csv
+    """
+    set_if_empty(info, "cn", info["user"])
+    set_if_empty(info, "sn", info["user"])
+    set_if_empty(info, "home", f'/home/{info["user"]}') # .format(**info)
+    info["no_create_home"] = (info["home"] == "-")
+    set_if_empty(info, "home_perm", "0700")
+    set_if_empty(info, "authorized_keys", "")
+    set_if_empty(info, "shell", "/bin/bash")
+    set_if_empty(info, "grp", info["user"])
+    if info.get("uid", "") == "":
+        info["uid"] = info["uid_alloc"].allocate(info["user"])
+    if info.get("gid", "") == "":
+        info["gid"] = info["uid"]
+    info["groups"] = info.get("groups", "").strip().split()
+    if info.get("password_hash", "") == "":
+        if info.get("password", "") == "":
+            info["password_hash"] = ""
+        else:
+            info["password_hash"] = slappasswd(info["password"], info)
+    info["ask_password"] = False
+
+def group_info_set_defaults(info):
+    """
+    set default values for a row of ldap_groups.csv
+    """
+    if info.get("gid", "") == "":
+        info["gid"] = info["gid_alloc"].allocate(info["grp"])
+
+def group_key(info):
+    """
+    dn of the group info["grp"]
+    """
+    return f'cn={info["grp"]},ou=groups,{info["ldap_domain"]}'
+
+def user_key(info):
+    """
+    dn of the user info["user"]
+    """
+    return f'uid={info["user"]},ou=people,{info["ldap_domain"]}'
+
+def group_ldif(info):
+    """
+    LDIF to add the group info["grp"]
+    """
+    ldif = f'''dn: cn={info["grp"]},ou=groups,{info["ldap_domain"]}
 objectClass: posixGroup
 cn: {info["grp"]}
 gidNumber: {info["gid"]}
 ''' # .format(**info)
-        return ldif
-    return add_ldif_if_not_exist(info["ldap_domain"], info["ldap_passwd"], key, gen_ldif, info)
+    return ldif
 
-def adduser(info):
+def user_ldif(info):
     """
-    add user to LDAP if it does not exist
+    LDIF to add the user info["user"]
     """
-    key = f'uid={info["user"]},ou=people,{info["ldap_domain"]}' # .format(**info)
-    def gen_ldif():
-        if info["password_hash"] is None:
-            if info["password"] is None:
-                if info["ask_password"]:
-                    info["password"] = ask_password(info["user"])
-            if info["password"] is not None:
-                info["password_hash"] = slappasswd(info["password"], info)
-        if info["password_hash"] is None:
-            info["user_password_hash"] = ""
-        else:
-            info["user_password_hash"] = f'userPassword: {info["password_hash"]}' # .format(**info)
-        ldif = f'''dn: uid={info["user"]},ou=people,{info["ldap_domain"]}
+    if info["password_hash"] is None:
+        if info["password"] is None:
+            if info["ask_password"]:
+                info["password"] = ask_password(info["user"])
+        if info["password"] is not None:
+            info["password_hash"] = slappasswd(info["password"], info)
+    if info["password_hash"] is None:
+        info["user_password_hash"] = ""
+    else:
+        info["user_password_hash"] = f'userPassword: {info["password_hash"]}' # .format(**info)
+    ldif = f'''dn: uid={info["user"]},ou=people,{info["ldap_domain"]}
 objectClass: inetOrgPerson
 objectClass: posixAccount
 objectClass: shadowAccount
@@ -226,26 +2309,83 @@ gidNumber: {info["gid"]}
 homeDirectory: {info["home"]}
 {info["user_password_hash"]}
 '''# .format(**info))
-        return ldif
-    return add_ldif_if_not_exist(info["ldap_domain"], info["ldap_passwd"], key, gen_ldif, info)
+    return ldif
+
+def modify_ldif(dn, mods):
+    """
+    LDIF to apply mods [(op, attr, [val, ...]), ...] to dn
+    """
+    lines = [ldif_value_line("dn", dn), "changetype: modify"]
+    for i, (op, attr, vals) in enumerate(mods):
+        if i:
+            lines.append("-")
+        lines.append(f"{op}: {attr}")
+        lines += [ldif_value_line(attr, val) for val in vals]
+    return "\n".join(lines) + "\n"
+
+def member_ldif(extra_group, users, info):
+    """
+    LDIF to add users to extra_group
+    """
+    lines = [f'dn: cn={extra_group},ou=groups,{info["ldap_domain"]}',
+             "changetype: modify",
+             "add: memberUid"]
+    lines += [f"memberUid: {user}" for user in users]
+    return "\n".join(lines) + "\n"
+
+def addgroup(info):
+    """
+    add a group to LDAP if it does not exist
+    """
+    return add_ldif_if_not_exist(info["ldap_domain"], info["ldap_passwd"],
+                                 group_key(info), lambda: group_ldif(info), info)
+
+def adduser(info):
+    """
+    add user to LDAP if it does not exist
+    """
+    return add_ldif_if_not_exist(info["ldap_domain"], info["ldap_passwd"],
+                                 user_key(info), lambda: user_ldif(info), info)
+
+def home_matches(home, uid_num, gid_num, perm):
+    """
+    check with a single stat if home exists with the owner and permissions
+    """
+    try:
+        st = os.stat(home)
+    except FileNotFoundError:
+        return False
+    return (st.st_uid == uid_num and st.st_gid == gid_num
+            and (st.st_mode & 0o7777) == perm)
+
+def make_parent_dirs(homes):
+    """
+    make the parent directories of homes (root-owned), each once
+    """
+    for parent_dir in sorted({os.path.dirname(home) for home in homes}):
+        os.makedirs(parent_dir, exist_ok=True, mode=0o755)
+        os.chown(parent_dir, uid=0, gid=0)
 
-def make_home(info):
+@profiled("mkdir")
+def make_home(info, make_parent=True):
     """
-    make a home directory for user (dictionary)
+    make a home directory for user (dictionary), and .ssh/authorized_keys
+    in it if missing.  the home is left as is if it already exists with
+    the right owner and permissions
     """
     home = info["home"]
-    perm = info["home_perm"]
+    perm = int(info["home_perm"], 8)
     uid_num = int(info["uid"])
     gid_num = int(info["gid"])
     pub_keys = info["authorized_keys"]
-    parent_dir = os.path.dirname(home)
     dot_ssh = f"{home}/.ssh"
     authorized_keys = f"{dot_ssh}/authorized_keys"# .format(dot_ssh)
-    os.makedirs(parent_dir, exist_ok=True, mode=0o755)
-    os.chown(parent_dir, uid=0, gid=0)
-    os.makedirs(home, exist_ok=True,
-                mode=int(perm, 8))
-    os.chown(home, uid=uid_num, gid=gid_num)
+    if not home_matches(home, uid_num, gid_num, perm):
+        if make_parent:
+            make_parent_dirs([home])
+        os.makedirs(home, exist_ok=True, mode=perm)
+        os.chown(home, uid=uid_num, gid=gid_num)
+        os.chmod(home, perm)
     if pub_keys:
         os.makedirs(dot_ssh, exist_ok=True, mode=0o700)
         os.chown(dot_ssh, uid=uid_num, gid=gid_num)
@@ -256,26 +2396,81 @@ def make_home(info):
             os.chmod(authorized_keys, 0o600)
     return 0                    # OK
 
+def make_homes(rows, info):
+    """
+    make home directories of rows [(origin, row), ...] with a pool of
+    info["home_workers"] threads (the calls are mostly waiting for NFS).
+    shared parent directories are made beforehand so that workers only
+    touch their own homes.  returns {origin : error message}
+    """
+    rows = [(origin, row) for origin, row in rows if not row["no_create_home"]]
+    if not rows:
+        return {}
+    errors = {}
+    try:
+        make_parent_dirs([row["home"] for _, row in rows])
+    except OSError as exc:
+        return {origin : f"home: {exc}" for origin, _ in rows}
+    def make(row):
+        try:
+            make_home(row, make_parent=False)
+            return None
+        except OSError as exc:
+            return f"home: {exc}"
+    workers = max(1, int(info.get("home_workers") or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        for (origin, _), err in zip(rows, pool.map(make, [row for _, row in rows])):
+            if err:
+                errors[origin] = err
+    return errors
+
+def authorized_keys_changed(info):
+    """
+    check if the existing home of info has authorized_keys
+    different from info["authorized_keys"] (or one that cannot be read)
+    """
+    if info["no_create_home"] or not info["authorized_keys"]:
+        return False
+    if not os.path.isdir(info["home"]):
+        return False
+    try:
+        with open(f'{info["home"]}/.ssh/authorized_keys', encoding="utf-8") as auth_key_fp:
+            return auth_key_fp.read() != info["authorized_keys"]
+    except OSError:
+        return True
+
+def update_authorized_keys(info):
+    """
+    (re)write authorized_keys in the home of info
+    """
+    uid_num = int(info["uid"])
+    gid_num = int(info["gid"])
+    dot_ssh = f'{info["home"]}/.ssh'
+    authorized_keys = f"{dot_ssh}/authorized_keys"
+    os.makedirs(dot_ssh, exist_ok=True, mode=0o700)
+    os.chown(dot_ssh, uid=uid_num, gid=gid_num)
+    with open(authorized_keys, "w", encoding="utf-8") as auth_key_wp:
+        auth_key_wp.write(info["authorized_keys"])
+    os.chown(authorized_keys, uid=uid_num, gid=gid_num)
+    os.chmod(authorized_keys, 0o600)
+    return 0                    # OK
+
 def add_user_to_group(info, extra_group):
     """
     add user to group
     """
     key = f'cn={extra_group},ou=groups,{info["ldap_domain"]}'
-                # .format(extra_group=extra_group, **info)
-    filt = f'(memberUid={info["user"]})'# .format(**info)
-    def gen_ldif():
-        ldif = f'''dn: cn={extra_group},ou=groups,{info["ldap_domain"]}
-changetype: modify
-add: memberUid
-memberUid: {info["user"]}'''
-                # .format(extra_group=extra_group, **info)
-        return ldif
-    return add_attr_val_ldif(info["ldap_domain"], info["ldap_passwd"],
-                             key, filt, gen_ldif, info)
-
-def adduser_group_home(info):
-    """
-    add user, its primary group, and home dir
+    filt = f'(memberUid={info["user"]})'
+    return add_attr_val_ldif(info["ldap_domain"], info["ldap_passwd"], key, filt,
+                             lambda: member_ldif(extra_group, [info["user"]], info),
+                             info)
+
+def adduser_group_home(info, add_groups=True, add_home=True):
+    """
+    add user, its primary group, and home dir.
+    the user is added to info["groups"] too unless add_groups is False
+    (the caller then adds memberships of many users with add_memberships).
+    likewise the home is not made if add_home is False (see make_homes)
     """
     err = adduser(info)
     if err:
@@ -283,8 +2478,8 @@ def adduser_group_home(info):
     err = addgroup(info)
     if err:
         return err
-    err = 0 if info["no_create_home"] else make_home(info)
-    if err:
+    err = 0 if info["no_create_home"] or not add_home else make_home(info)
+    if err or not add_groups:
         return err
     for extra_group in info["groups"]:
         err = add_user_to_group(info, extra_group)
@@ -318,6 +2513,22 @@ def get_default_ldap_domain():
                 return matched.group("dom")
     return ""
 
+def get_default_ldap_uri():
+    """
+    get ldap uri
+    """
+    pat = re.compile("^uri +(?P<uri>.*)$")
+    try:
+        with open("/etc/ldap.conf", encoding="utf-8") as conf_fp:
+            for line in conf_fp:
+                matched = pat.match(line)
+                if matched:
+                    return matched.group("uri").split()[0]
+    except FileNotFoundError:
+        pass
+    return "ldap://localhost/"
+
+@functools.lru_cache(maxsize=None)
 def get_default_ldap_passwd_really():
     """
     get ldap passwd
@@ -330,3 +2541,12 @@ def get_default_ldap_passwd():
     get ldap passwd
     """
     return "$(cat /etc/ldap.secret)"
+
+def resolve_ldap_passwd(passwd):
+    """
+    the real password for passwd, which may be the shell expression
+    returned by get_default_ldap_passwd
+    """
+    if passwd == get_default_ldap_passwd():
+        return get_default_ldap_passwd_really().strip()
+    return passwd
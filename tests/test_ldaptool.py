@@ -0,0 +1,95 @@
+import csv
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "roles", "ldap_server", "files", "ldaptool", "bin"))
+
+import ldaptool
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.csv = os.path.join(self.tmp.name, "users.csv")
+        with open(self.csv, "w", encoding="utf-8", newline="") as csv_wp:
+            writer = csv.writer(csv_wp)
+            writer.writerow(["user"])
+            for i in range(6):
+                writer.writerow([f"u{i}"])
+        self.info = {"file" : [self.csv], "batch_size" : 2, "exit_on_error" : False,
+                     "checkpoint" : os.path.join(self.tmp.name, "ckpt.json"),
+                     "resume" : False}
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_chunks(self, failing=()):
+        """
+        process the csv, failing the rows of the users in failing; return
+        the users processed and the exit status
+        """
+        seen = []
+        def process_chunk(chunk):
+            seen.extend(row["user"] for _, row in chunk)
+            errors = {origin : 1 for origin, row in chunk if row["user"] in failing}
+            return errors, [origin for origin, _ in chunk]
+        with contextlib.redirect_stdout(io.StringIO()):
+            err = ldaptool.process_in_chunks(self.info, process_chunk)
+        return seen, err
+
+    def test_resume_after_failure_not_stopping(self):
+        seen, err = self.run_chunks(failing=("u2",))
+        self.assertEqual((seen, err), (["u0", "u1", "u2", "u3", "u4", "u5"], 1))
+        with open(self.info["checkpoint"], encoding="utf-8") as ckpt_fp:
+            self.assertEqual(json.load(ckpt_fp)["files"][self.csv]["done"], 1)
+        self.info["resume"] = True
+        seen, err = self.run_chunks()
+        self.assertEqual((seen, err), (["u2", "u3", "u4", "u5"], 0))
+        seen, err = self.run_chunks()
+        self.assertEqual((seen, err), ([], 0))
+
+    def test_resume_after_exit_on_error(self):
+        self.info["exit_on_error"] = True
+        seen, _ = self.run_chunks(failing=("u3",))
+        self.assertEqual(seen, ["u0", "u1", "u2", "u3"])
+        self.info["resume"] = True
+        seen, _ = self.run_chunks()
+        self.assertEqual(seen, ["u3", "u4", "u5"])
+
+
+class TestDryRun(unittest.TestCase):
+
+    def test_ldap_backend_does_not_bind(self):
+        """
+        --run 0 with the ldap backend neither binds nor reads the password
+        """
+        class FakeLdap:
+            SCOPE_BASE, SCOPE_ONELEVEL, SCOPE_SUBTREE = range(3)
+            def initialize(self, uri):
+                raise AssertionError(f"connected to {uri}")
+        info = {"backend" : "ldap", "run" : 0, "verbose" : 0,
+                "ldap_passwd" : os.path.join(os.devnull, "missing"),
+                "ldap_domain" : "dc=example,dc=com",
+                "ldap_uri" : "ldap://nonexistent.invalid/"}
+        saved = ldaptool.ldap
+        ldaptool.ldap = FakeLdap()
+        try:
+            conn = ldaptool.connect(info)
+            self.assertEqual(conn.search("ou=people,dc=example,dc=com"), (0, []))
+            self.assertEqual(list(conn.search_paged("ou=people,dc=example,dc=com")), [])
+            self.assertEqual(conn.add("dn: uid=u1,ou=people,dc=example,dc=com\n"
+                                      "uid: u1\n"), 0)
+            conn.close()
+        finally:
+            ldaptool.ldap = saved
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mdxcsv2inventory
+
+HEADER = ("VM_NAME,SERVICE_NET_1_IPv4,SERVICE_NET_1_IPv6," +
+          "STORAGE_NET_1_IPv4,STORAGE_NET_1_IPv6,STATUS\n")
+
+
+def all_vars_of(text, *options):
+    args = mdxcsv2inventory.parse_args([os.devnull] + list(options))
+    args.csv[0].close()
+    vms = mdxcsv2inventory.csv2dictlist(io.StringIO(HEADER + text))
+    table = mdxcsv2inventory.validate_vms(vms, args.enable_linklocal)
+    return dict(mdxcsv2inventory.get_all_vars(table, args))
+
+
+class TestPrefixes(unittest.TestCase):
+
+    def test_one_subnet(self):
+        all_vars = all_vars_of("vm1,10.12.0.2,2001:db8::1,10.13.0.2,,Running\n"
+                               "vm2,10.12.3.9,2001:db8::2,10.13.0.3,,Running\n")
+        self.assertEqual(all_vars["ethipv4prefix"], ["10.12.0.0/21"])
+        self.assertEqual(all_vars["rdmaipv4prefix"], ["10.13.0.0/21"])
+        self.assertEqual(all_vars["ethipv6prefix"], ["2001:db8::/64"])
+
+    def test_distant_subnets(self):
+        all_vars = all_vars_of("vm1,10.12.0.2,,10.12.0.2,,Running\n"
+                               "vm2,192.168.0.1,,192.168.0.1,,Running\n")
+        self.assertEqual(all_vars["ethipv4prefix"],
+                         ["10.12.0.0/21", "192.168.0.0/21"])
+        self.assertEqual(all_vars["rdmaipv4prefix"],
+                         ["10.12.0.0/21", "192.168.0.0/21"])
+
+    def test_adjacent_subnets_collapsed(self):
+        all_vars = all_vars_of("vm1,10.12.0.2,,,,Running\n"
+                               "vm2,10.12.8.2,,,,Running\n")
+        self.assertEqual(all_vars["ethipv4prefix"], ["10.12.0.0/20"])
+
+    def test_ipv6_low_addresses(self):
+        all_vars = all_vars_of("vm1,,::1,,,Running\n", "-6")
+        self.assertEqual(all_vars["ethipv6prefix"], ["::/64"])
+
+    def test_link_local_not_in_prefix(self):
+        all_vars = all_vars_of("vm1,10.12.0.2,2001:db8::1,,,Running\n"
+                               "vm2,10.12.0.3,fe80::1,,,Running\n",
+                               "--enable-linklocal", "-6")
+        self.assertEqual(all_vars["ethipv6prefix"], ["2001:db8::/64"])
+
+
+class TestReadVms(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_csv(self, name, names):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w", encoding = "utf-8") as f:
+            f.write(HEADER)
+            for n, vm_name in enumerate(names):
+                f.write("{},10.12.0.{},,,,Running\n".format(vm_name, n + 2))
+        return path
+
+    def read_vms(self, *paths):
+        args = mdxcsv2inventory.parse_args(list(paths))
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            vms, projects = mdxcsv2inventory.read_vms(args)
+        for f in args.csv:
+            f.close()
+        return [vm["VM_NAME"] for vm in vms], projects, stderr.getvalue()
+
+    def test_sorted_file_streamed(self):
+        path = self.write_csv("a.csv", ["vm1", "vm2"])
+        with open(path, encoding = "utf_8_sig") as f:
+            rows = mdxcsv2inventory.sorted_rows(f)
+            self.assertNotIsInstance(rows, list)
+            self.assertEqual([row["VM_NAME"] for row in rows], ["vm1", "vm2"])
+
+    def test_merge(self):
+        a = self.write_csv("a.csv", ["vm1", "vm3", "vm5"])
+        b = self.write_csv("b.csv", ["vm4", "vm3", "vm2"])
+        names, projects, stderr = self.read_vms(a, b)
+        self.assertEqual(names, ["vm1", "vm2", "vm3", "vm4", "vm5"])
+        self.assertEqual(projects, [0, 1, 0, 1, 0])
+        self.assertIn("duplicate VM name vm3", stderr)
+
+
+if __name__ == "__main__":
+    unittest.main()